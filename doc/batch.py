@@ -0,0 +1,162 @@
+from argparse import ArgumentParser
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from glob import glob
+import os
+import sys
+import time
+
+import numpy as np
+
+import bmp
+import jpeg_encoder
+from jpeg_decoder import Jpeg
+
+# 扩展名 -> 格式
+INPUT_FORMATS = {
+    '.bmp': 'bmp',
+    '.jpg': 'jpeg',
+    '.jpeg': 'jpeg',
+}
+# 输出格式 -> 扩展名，none 表示只解码不写出
+OUTPUT_FORMATS = {
+    'bmp': '.bmp',
+    'jpeg': '.jpg',
+    'npy': '.npy',
+    'raw': '.raw',
+    'none': '',
+}
+
+def collect_inputs(sources: list) -> list:
+    'Directories, glob patterns and manifest files (one path per line) -> BMP/JPEG paths in the given order'
+    paths = []
+    for source in sources:
+        if os.path.isdir(source):
+            found = sorted(os.path.join(source, name) for name in os.listdir(source))
+        elif os.path.isfile(source) and os.path.splitext(source)[1].lower() not in INPUT_FORMATS:
+            # 清单文件：相对路径以清单所在目录为基准，忽略空行和 # 注释
+            base = os.path.dirname(source)
+            with open(source, encoding='utf-8') as f:
+                found = [os.path.join(base, line.strip()) for line in f
+                         if line.strip() and not line.lstrip().startswith('#')]
+        else:
+            found = sorted(glob(source, recursive=True))
+            if not found:
+                raise ValueError(f'Input Error, Nothing Matches({source})')
+        paths.extend(path for path in found
+                     if os.path.isfile(path) and os.path.splitext(path)[1].lower() in INPUT_FORMATS)
+    return paths
+
+def decode_file(path: str):
+    'Decode one BMP/JPEG file -> H x W x 3 (or H x W) uint8 pixels'
+    if INPUT_FORMATS[os.path.splitext(path)[1].lower()] == 'bmp':
+        return np.asarray(bmp.read_file(path)[0])
+    return np.asarray(Jpeg(path).pixels)
+
+def write_output(path: str, pixels: np.ndarray, output_format: str, quality=75):
+    if output_format == 'bmp':
+        bmp.write_file(path, pixels)
+    elif output_format == 'jpeg':
+        jpeg_encoder.write_file(path, pixels, quality)
+    elif output_format == 'npy':
+        np.save(path, pixels)
+    elif output_format == 'raw':
+        with open(path, 'wb') as f:
+            f.write(np.ascontiguousarray(pixels).tobytes())
+
+def process_file(path: str, output_dir: str, output_format: str, quality=75):
+    'Pool worker: decode, write and time one file -> result dict'
+    start = time.perf_counter()
+    result = {'path': path, 'bytes': os.path.getsize(path), 'output': None, 'error': None}
+    try:
+        pixels = decode_file(path)
+        result['shape'] = pixels.shape
+        if output_format != 'none':
+            # 保留原扩展名，避免 a.jpg 和 a.bmp 输出到同一个文件
+            name = os.path.basename(path) + OUTPUT_FORMATS[output_format]
+            result['output'] = os.path.join(output_dir, name)
+            write_output(result['output'], pixels, output_format, quality)
+    except Exception as e:
+        # 单个文件失败不影响整批
+        result['error'] = f'{type(e).__name__}: {e}'
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+def run_batch(paths: list, output_dir: str, output_format='none', processes=None, max_in_flight=None, quality=75
+              , callback=None):
+    'Decode paths through a process pool keeping at most max_in_flight files queued, results in input order'
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f'Output Format Error, Expect one of {list(OUTPUT_FORMATS)}, Read({output_format})')
+    if output_format != 'none':
+        os.makedirs(output_dir, exist_ok=True)
+    processes = processes or os.cpu_count() or 1
+    # 限制同时提交的任务数，避免一次提交整批文件占满内存
+    max_in_flight = max(1, max_in_flight or processes * 2)
+    results = [None] * len(paths)
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        pending = {}
+        queue = iter(enumerate(paths))
+        while True:
+            for index, path in queue:
+                pending[pool.submit(process_file, path, output_dir, output_format, quality)] = index
+                if len(pending) >= max_in_flight:
+                    break
+            if not pending:
+                break
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                index = pending.pop(future)
+                results[index] = future.result()
+                if callback:
+                    callback(results[index])
+    return results
+
+def summarize(results: list, elapsed: float) -> dict:
+    'Batch totals: images/s and MB/s over wall time, latency percentiles over the successful files'
+    succeeded = [result for result in results if not result['error']]
+    latencies = np.array([result['seconds'] for result in succeeded])
+    total_bytes = sum(result['bytes'] for result in succeeded)
+    return {
+        'files': len(results),
+        'failed': len(results) - len(succeeded),
+        'seconds': elapsed,
+        'images_per_second': len(succeeded) / elapsed if elapsed else 0.0,
+        'mb_per_second': total_bytes / 1e6 / elapsed if elapsed else 0.0,
+        'latency_mean': float(latencies.mean()) if len(latencies) else 0.0,
+        'latency_p50': float(np.percentile(latencies, 50)) if len(latencies) else 0.0,
+        'latency_p95': float(np.percentile(latencies, 95)) if len(latencies) else 0.0,
+    }
+
+def print_result(result: dict):
+    if result['error']:
+        print(f'FAIL {result["path"]}: {result["error"]}')
+    else:
+        shape = 'x'.join(str(size) for size in result['shape'])
+        print(f'{result["seconds"] * 1000:9.1f} ms  {result["bytes"] / 1e6:8.2f} MB  {shape:>14}  {result["path"]}')
+
+def print_summary(summary: dict):
+    print(f'{summary["files"]} files, {summary["failed"]} failed, {summary["seconds"]:.3f} s')
+    print(f'{summary["images_per_second"]:.2f} images/s, {summary["mb_per_second"]:.2f} MB/s (input)')
+    print(f'latency mean {summary["latency_mean"] * 1000:.1f} ms, p50 {summary["latency_p50"] * 1000:.1f} ms'
+          f', p95 {summary["latency_p95"] * 1000:.1f} ms')
+
+def main(argv=None):
+    parser = ArgumentParser(description='Decode BMP/JPEG files in batch')
+    parser.add_argument('inputs', nargs='+', help='directories, glob patterns or manifest files')
+    parser.add_argument('-o', '--output', default='./out', help='output directory')
+    parser.add_argument('-f', '--format', default='none', choices=list(OUTPUT_FORMATS), help='output format')
+    parser.add_argument('-j', '--processes', type=int, default=None, help='worker processes, default CPU count')
+    parser.add_argument('--in-flight', type=int, default=None, help='max queued files, default 2 x processes')
+    parser.add_argument('-q', '--quality', type=int, default=75, help='JPEG output quality')
+    parser.add_argument('--quiet', action='store_true', help='only print the summary')
+    args = parser.parse_args(argv)
+
+    paths = collect_inputs(args.inputs)
+    start = time.perf_counter()
+    results = run_batch(paths, args.output, args.format, args.processes, args.in_flight, args.quality
+                        , None if args.quiet else print_result)
+    summary = summarize(results, time.perf_counter() - start)
+    print_summary(summary)
+    return 1 if summary['failed'] else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,209 @@
+from argparse import ArgumentParser
+from glob import glob
+from io import BytesIO
+import json
+import os
+import platform
+import sys
+import time
+
+import numpy as np
+
+import bmp
+import jpeg_encoder
+from jpeg_decoder import Frame, Jpeg
+
+# 名称 -> (宽, 高)
+SIZES = {
+    '64': (64, 64),
+    '256': (256, 256),
+    '1024': (1024, 1024),
+    '2048': (2048, 2048),
+    '4k': (3840, 2160),
+    '8k': (7680, 4320),
+}
+DEFAULT_SIZES = ['64', '256', '1024']
+DEFAULT_SUBSAMPLING = ['4:4:4', '4:2:2', '4:2:0']
+DEFAULT_RESTART = [0, 16]
+REAL_IMAGES = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'img')
+
+def synthetic_pixels(width, height, seed=0):
+    'Deterministic RGB test image: gradients, a few frequencies and noise, so every coefficient band is used'
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    r = 255 * x / max(1, width - 1)
+    g = 128 + 100 * np.sin(x / 7) * np.cos(y / 11)
+    b = 255 * y / max(1, height - 1)
+    pixels = np.stack([r, g, b], axis=2) + rng.normal(0, 12, (height, width, 3))
+    return np.clip(pixels, 0, 255).astype(np.uint8)
+
+def generate_cases(data_dir, sizes, subsamplings, restarts, quality=85):
+    'Write (or reuse) synthetic JPEG and BMP files -> [(case name, path)]'
+    os.makedirs(data_dir, exist_ok=True)
+    cases = []
+    for size in sizes:
+        width, height = SIZES[size]
+        pixels = None
+        path = os.path.join(data_dir, f'syn_{size}.bmp')
+        if not os.path.exists(path):
+            pixels = synthetic_pixels(width, height)
+            bmp.write_file(path, pixels)
+        cases.append((f'bmp_{size}', path))
+        for subsampling in subsamplings:
+            for restart in restarts:
+                name = f'jpeg_{size}_{subsampling.replace(":", "")}_rst{restart}'
+                path = os.path.join(data_dir, f'syn_{size}_{subsampling.replace(":", "")}_rst{restart}.jpg')
+                if not os.path.exists(path):
+                    if pixels is None:
+                        pixels = synthetic_pixels(width, height)
+                    jpeg_encoder.write_file(path, pixels, quality, subsampling, restart_interval=restart)
+                cases.append((name, path))
+    return cases
+
+def real_cases():
+    return [(f'real_{os.path.basename(path).replace(".", "_")}', path)
+            for path in sorted(glob(os.path.join(REAL_IMAGES, '*')))
+            if os.path.splitext(path)[1].lower() in ('.bmp', '.jpg', '.jpeg')]
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+def encode_pixels(pixels, quality=85):
+    'jpeg_encoder.write_file into memory'
+    quantization_tables = [jpeg_encoder.quality_table(jpeg_encoder.STD_LUMINANCE_QUANTIZATION, quality)
+                           , jpeg_encoder.quality_table(jpeg_encoder.STD_CHROMINANCE_QUANTIZATION, quality)]
+    units, vectors, factors, _ = jpeg_encoder.prepare_units(pixels, quantization_tables)
+    out = BytesIO()
+    jpeg_encoder.write_header(out, pixels.shape[1], pixels.shape[0], quantization_tables, factors)
+    jpeg_encoder.write_data(out, jpeg_encoder.dc_differences(units, vectors), vectors)
+    jpeg_encoder.write_eoi(out)
+    return out.getvalue()
+
+def bench_jpeg(path):
+    'One pass over every decode stage of a JPEG file -> {stage: seconds}'
+    times = {}
+    with open(path, 'rb') as f:
+        times['read_file'], content = timed(f.read)
+    jpeg = Jpeg.__new__(Jpeg)
+    jpeg.frame = Frame()
+    times['read_segments'], segments = timed(Jpeg.read_segments, content)
+    times['parse_segments'], _ = timed(jpeg._parse_segments, segments)
+    times['build_tables'], _ = timed(jpeg._build_frame)
+    frame = jpeg.frame
+    times['decode_huffman'], _ = timed(frame.decode_huffman)
+    times['decode_quantization'], _ = timed(frame.decode_quantization, 8)
+    times['idct'], _ = timed(frame.idct)
+    times['color_convert'], pixels = timed(frame.color_convert, 'fancy')
+    height, width = pixels.shape[:2]
+    times['encode'], _ = timed(encode_pixels, pixels)
+    times['total_decode'] = sum(times[stage] for stage in ('read_file', 'read_segments', 'parse_segments'
+                                                           , 'build_tables', 'decode_huffman', 'decode_quantization'
+                                                           , 'idct', 'color_convert'))
+    return times, width * height
+
+def bench_bmp(path):
+    'One pass over the BMP reader and writer -> {stage: seconds}'
+    times = {}
+    with open(path, 'rb') as f:
+        start = time.perf_counter()
+        _, _, bfOffBits = bmp.read_header(f)
+        _, biWidth, biHeight = bmp.read_info(f)
+        f.seek(bfOffBits)
+        times['read_header'] = time.perf_counter() - start
+        times['read_data'], pixels = timed(bmp.read_data, f, biWidth, biHeight)
+    out = BytesIO()
+    start = time.perf_counter()
+    bmp.write_header(out, biWidth, biHeight)
+    bmp.write_data(out, [pixels], biWidth, biHeight)
+    times['write'] = time.perf_counter() - start
+    return times, biWidth * abs(biHeight)
+
+def run_case(path, repeat=3, max_pixels_repeat=4_000_000):
+    'Best (minimum) time of every stage over repeat passes, images over max_pixels_repeat run only once'
+    bench = bench_bmp if path.lower().endswith('.bmp') else bench_jpeg
+    runs = []
+    times, pixel_count = bench(path)
+    runs.append(times)
+    for _ in range(repeat - 1 if pixel_count <= max_pixels_repeat else 0):
+        runs.append(bench(path)[0])
+    result = {stage: min(run[stage] for run in runs) for stage in runs[0]}
+    result['pixels'] = pixel_count
+    result['bytes'] = os.path.getsize(path)
+    return result
+
+def run_benchmark(cases, repeat=3, progress=None):
+    'Time every (name, path) case -> JSON-ready dict with machine info'
+    results = {}
+    for name, path in cases:
+        results[name] = run_case(path, repeat)
+        if progress:
+            progress(name, results[name])
+    return {
+        'meta': {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'machine': platform.machine(),
+            'processor': platform.processor(),
+            'repeat': repeat,
+        },
+        'results': results,
+    }
+
+def compare(current: dict, baseline: dict, threshold=0.1, min_seconds=0.001):
+    'Stages slower than baseline by more than threshold (and by at least min_seconds) -> [(case, stage, old, new)]'
+    regressions = []
+    for name, stages in current['results'].items():
+        old_stages = baseline['results'].get(name)
+        if not old_stages:
+            continue
+        for stage, seconds in stages.items():
+            if stage in ('pixels', 'bytes') or stage not in old_stages:
+                continue
+            old = old_stages[stage]
+            if seconds > old * (1 + threshold) and seconds - old >= min_seconds:
+                regressions.append((name, stage, old, seconds))
+    return regressions
+
+def print_case(name, result):
+    stages = '  '.join(f'{stage} {seconds * 1000:.1f}' for stage, seconds in result.items()
+                       if stage not in ('pixels', 'bytes'))
+    print(f'{name:<28} {result["pixels"] / 1e6:6.2f} MP  {stages} (ms)')
+
+def main(argv=None):
+    parser = ArgumentParser(description='Time every decode/encode stage on synthetic and sample images')
+    parser.add_argument('--sizes', nargs='+', default=DEFAULT_SIZES, choices=list(SIZES))
+    parser.add_argument('--full', action='store_true', help='all sizes, 64x64 up to 8K')
+    parser.add_argument('--subsampling', nargs='+', default=DEFAULT_SUBSAMPLING
+                        , choices=list(jpeg_encoder.SUBSAMPLING))
+    parser.add_argument('--restart', nargs='+', type=int, default=DEFAULT_RESTART, help='restart intervals in MCUs')
+    parser.add_argument('--no-real', action='store_true', help='skip the sample images in img/')
+    parser.add_argument('--data', default='./bench_data', help='where synthetic images are generated')
+    parser.add_argument('--repeat', type=int, default=3, help='passes per case, the minimum is kept')
+    parser.add_argument('--save', help='write results as JSON')
+    parser.add_argument('--baseline', help='compare against a saved JSON result')
+    parser.add_argument('--threshold', type=float, default=0.1, help='allowed slowdown, 0.1 = 10%%')
+    args = parser.parse_args(argv)
+
+    sizes = list(SIZES) if args.full else args.sizes
+    cases = generate_cases(args.data, sizes, args.subsampling, args.restart)
+    if not args.no_real:
+        cases += real_cases()
+    current = run_benchmark(cases, args.repeat, progress=print_case)
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as f:
+            json.dump(current, f, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare(current, baseline, args.threshold)
+        for name, stage, old, new in regressions:
+            print(f'REGRESSION {name} {stage}: {old * 1000:.2f} ms -> {new * 1000:.2f} ms ({new / old - 1:+.0%})')
+        print(f'{len(regressions)} regressions against {args.baseline}')
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
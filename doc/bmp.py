@@ -1,7 +1,13 @@
-from struct import unpack
+from struct import pack, unpack
 from enum import Enum
-import PIL.Image
-from io import BufferedReader
+from io import BufferedReader, BufferedWriter
+from itertools import chain
+from mmap import ACCESS_READ, mmap
+
+import numpy as np
+
+from instrument import get_observer
+from raster import Raster
 
 class BfType(Enum):
     BM = b'BM'  # Windows 3.1x, 95, NT, ...
@@ -18,6 +24,29 @@ class BiCompression(Enum):
     BI_BITFIELDS = 3    # bit域，用于16位/32位 位图
     BI_JPEG = 4         # 位图含JPEG图像（仅用于打印机）
     BI_PNG = 5          # 位图含PNG图像（仅用于打印机）
+    BI_ALPHABITFIELDS = 6   # bit域（含alpha掩码），用于16位/32位 位图
+
+# BI_RGB 时16位/32位像素的默认掩码 (R, G, B)
+DEFAULT_MASKS = {
+    16: (0x7C00, 0x03E0, 0x001F),
+    32: (0xFF0000, 0x00FF00, 0x0000FF),
+}
+
+class BitmapInfo:
+    'Bitmap information header (core / info / V4 / V5) with the bit field masks and the palette that follow it'
+    # masks     (R, G, B) 位掩码，16位/32位时才有；alpha掩码忽略
+    # palette   (N, 3) RGB 调色板，1/4/8位时才有
+    def __init__(self) -> None:
+        self.size = 40
+        self.width = 0
+        self.height = 0
+        self.planes = 1
+        self.bit_count = 24
+        self.compression = BiCompression.BI_RGB
+        self.size_image = 0
+        self.clr_used = 0
+        self.masks = None
+        self.palette = None
 
 # Read
 def read_header(f: BufferedReader):
@@ -28,53 +57,342 @@ def read_header(f: BufferedReader):
     bfOffBits = unpack('<i', f.read(4))[0]  # 从文件头到位图数据部分的偏移量
     return bfType, bfSize, bfOffBits
 
+def read_bitmap_info(f: BufferedReader) -> BitmapInfo:
+    'Information header, then the BI_BITFIELDS masks and the palette, leaving f at the end of the palette'
+    info = BitmapInfo()
+    info.size = unpack('<i', f.read(4))[0]                          # infomation 部分的字节数
+    if info.size == 12:
+        # OS/2 BITMAPCOREHEADER：宽高为16位，调色板每项3字节
+        info.width, info.height, info.planes, info.bit_count = unpack('<hhhh', f.read(8))
+        entry_size = 3
+    elif info.size >= 40:
+        header = f.read(info.size - 4)
+        info.width = unpack('<i', header[0:4])[0]                   # 图像宽度（像素）
+        info.height = unpack('<i', header[4:8])[0]                  # 图像高度（像素）
+        info.planes = unpack('<h', header[8:10])[0]                 # 颜色平面数
+        info.bit_count = unpack('<h', header[10:12])[0]             # 像素位宽
+        info.compression = BiCompression(unpack('<i', header[12:16])[0])    # 压缩类型
+        info.size_image = unpack('<i', header[16:20])[0]            # 图像大小（字节）
+        info.clr_used = unpack('<i', header[28:32])[0]              # 颜色索引数
+        entry_size = 4
+        if info.compression in (BiCompression.BI_BITFIELDS, BiCompression.BI_ALPHABITFIELDS):
+            if info.size >= 52:
+                # V4/V5 头中直接包含掩码
+                info.masks = unpack('<III', header[36:48])
+            elif info.compression is BiCompression.BI_BITFIELDS:
+                info.masks = unpack('<III', f.read(12))
+            else:
+                info.masks = unpack('<IIII', f.read(16))[:3]
+    else:
+        raise ValueError(f'Info Header Error, Unsupported Size({info.size})')
+    if info.bit_count <= 8:
+        # 调色板项为 BGR(X)，颜色索引数为0时取 2^位宽
+        count = info.clr_used or 1 << info.bit_count
+        palette = np.frombuffer(f.read(count * entry_size), np.uint8)
+        info.palette = np.ascontiguousarray(palette[:len(palette) // entry_size * entry_size]
+                                            .reshape(-1, entry_size)[:, 2::-1])
+        if not len(info.palette):
+            raise ValueError(f'Palette Error, Expect({count}) Entries, Read(0)')
+    elif info.masks is None and info.bit_count in DEFAULT_MASKS:
+        info.masks = DEFAULT_MASKS[info.bit_count]
+    return info
+
 def read_info(f: BufferedReader):
-    biSize = unpack('<i', f.read(4))[0]                         # infomation 部分的字节数
-    biWidth = unpack('<i', f.read(4))[0]                        # 图像宽度（像素）
-    biHeight = unpack('<i', f.read(4))[0]                       # 图像高度（像素）
-    biPlanes = unpack('<h', f.read(2))[0]                       # 颜色平面数
-    biBitCount = unpack('<h', f.read(2))[0]                     # 像素位宽
-    biCompression = BiCompression(unpack('<i', f.read(4))[0])   # 压缩类型
-    biSizeImage = unpack('<i', f.read(4))[0]                    # 图像大小（字节）
-    biXPelsPerMeter = unpack('<i', f.read(4))[0]                # 水平分辨率（像素/米）
-    biYPelsPerMeter = unpack('<i', f.read(4))[0]                # 垂直分辨率（像素/米）
-    biClrUsed = unpack('<i', f.read(4))[0]                      # 颜色索引数
-    biClrImportant = unpack('<i', f.read(4))[0]                 # 颜色索引数（重要）
-    return biSizeImage, biWidth, biHeight
+    info = read_bitmap_info(f)
+    return info.size_image, info.width, info.height
 
 def read_data(f: BufferedReader, biWidth, biHeight):
-    pixels = [0] * biWidth * biHeight
-    for row in range(biHeight - 1, -1, -1):
-        for col in range(biWidth - 1, -1, -1):
-            b = unpack('<B', f.read(1))[0]
-            g = unpack('<B', f.read(1))[0]
-            r = unpack('<B', f.read(1))[0]
-            pixels[row * biHeight + col] = (r, g, b)
-            # pixels.append((r, g, b))
-        pad_count = biWidth % 4
-        _ = f.read(pad_count)
+    # 每行按4字节对齐；biHeight > 0 时自下而上存储，< 0 时自上而下
+    height = abs(biHeight)
+    stride = (biWidth * 3 + 3) // 4 * 4
+    data = f.read(stride * height)
+    if len(data) != stride * height:
+        raise ValueError(f'Data Length Error, Expect({stride * height}), Read({len(data)})')
+    pixels = np.frombuffer(data, np.uint8).reshape(height, stride)[:, :biWidth * 3].reshape(height, biWidth, 3)
+    if biHeight > 0:
+        pixels = pixels[::-1]
+    # BGR -> RGB
+    return np.ascontiguousarray(pixels[:, :, ::-1])
+
+def read_rows(f: BufferedReader, info: BitmapInfo):
+    'Uncompressed rows of any bit count, top-down (height, stride) bytes'
+    height = abs(info.height)
+    stride = (info.width * info.bit_count + 31) // 32 * 4
+    data = f.read(stride * height)
+    if len(data) != stride * height:
+        raise ValueError(f'Data Length Error, Expect({stride * height}), Read({len(data)})')
+    rows = np.frombuffer(data, np.uint8).reshape(height, stride)
+    return rows[::-1] if info.height > 0 else rows
+
+def unpack_indices(rows: np.ndarray, width, bit_count):
+    # 1/4/8位的调色板索引，高位在前
+    if bit_count == 8:
+        return rows[:, :width]
+    if bit_count == 4:
+        indices = np.empty((len(rows), rows.shape[1] * 2), np.uint8)
+        indices[:, 0::2] = rows >> 4
+        indices[:, 1::2] = rows & 0x0F
+        return indices[:, :width]
+    if bit_count == 1:
+        return np.unpackbits(rows, axis=1)[:, :width]
+    raise ValueError(f'Bit Count Error, Unsupported Palette Bit Count({bit_count})')
+
+def apply_masks(values: np.ndarray, masks):
+    'Packed pixel values -> (..., 3) RGB, one whole-array shift and mask per channel, scaled to 8 bits'
+    pixels = np.zeros(values.shape + (3,), np.uint8)
+    for channel, mask in enumerate(masks):
+        if not mask:
+            continue
+        shift = (mask & -mask).bit_length() - 1
+        bits = (mask >> shift).bit_length()
+        field = (values >> shift) & ((1 << bits) - 1)
+        if bits == 8:
+            pixels[..., channel] = field
+        elif bits <= 16:
+            # n位的分量线性扩展到 0~255
+            maximum = (1 << bits) - 1
+            pixels[..., channel] = np.rint(np.arange(maximum + 1) * (255 / maximum)).astype(np.uint8)[field]
+        else:
+            pixels[..., channel] = field >> (bits - 8)
     return pixels
 
+def decode_bitfields(rows: np.ndarray, info: BitmapInfo):
+    width = info.width
+    if info.bit_count == 16:
+        values = rows[:, :width * 2].copy().view('<u2')
+        # 16位像素只有65536种取值，先按掩码算出整张查找表，再一次取值
+        return apply_masks(np.arange(1 << 16, dtype=np.uint32), info.masks)[values]
+    if info.bit_count != 32:
+        raise ValueError(f'Bit Count Error, Bit Fields Need 16 or 32 Bits, Read({info.bit_count})')
+    byte_masks = [0xFF << (8 * index) for index in range(4)]
+    if all(mask in byte_masks for mask in info.masks):
+        # 按字节对齐的掩码（BGRX等）直接按字节取出，不做移位
+        pixels = rows[:, :width * 4].reshape(len(rows), width, 4)
+        return np.ascontiguousarray(pixels[..., [byte_masks.index(mask) for mask in info.masks]])
+    return apply_masks(rows[:, :width * 4].copy().view('<u4'), info.masks)
+
+def exclusive_cumsum(values: np.ndarray):
+    result = np.zeros(len(values), np.int64)
+    np.cumsum(values[:-1], out=result[1:])
+    return result
+
+def ragged_arange(starts: np.ndarray, lengths: np.ndarray):
+    'Ranges start .. start + length concatenated -> (positions, offset inside each range)'
+    inside = np.arange(lengths.sum()) - np.repeat(exclusive_cumsum(lengths), lengths)
+    return np.repeat(starts, lengths) + inside, inside
+
+def runs_array(runs: list):
+    # 元组列表 -> (n, 3)，逐项转换比 np.array 快得多
+    return np.fromiter(chain.from_iterable(runs), np.int64, 3 * len(runs)).reshape(-1, 3)
+
+def rle_runs(data: bytes, width, height, bit_count):
+    '''RLE8/RLE4 commands -> fills [(dest, count, value)] and copies [(dest, count, source offset)]
+    只按命令循环，dest 为自下而上的像素位置，超出行尾的像素丢弃'''
+    fills = []
+    copies = []
+    x = y = 0
+    pos = 0
+    size = len(data)
+    while pos + 1 < size and y < height:
+        count, value = data[pos], data[pos + 1]
+        pos += 2
+        if count:
+            # 编码模式：count个value；RLE4时两个半字节交替
+            if x < width:
+                fills.append((y * width + x, min(count, width - x), value))
+            x += count
+        elif value == 0:
+            # 行结束
+            x, y = 0, y + 1
+        elif value == 1:
+            # 位图结束
+            break
+        elif value == 2:
+            # 偏移：向右dx、向上dy，跳过的像素为0号颜色
+            x += data[pos]
+            y += data[pos + 1]
+            pos += 2
+        else:
+            # 绝对模式：后面跟value个像素，按2字节对齐
+            length = value if bit_count == 8 else (value + 1) // 2
+            if x < width:
+                copies.append((y * width + x, min(value, width - x), pos))
+            x += value
+            pos += length + (length & 1)
+    return fills, copies
+
+def decode_rle(data: bytes, width, height, bit_count):
+    'RLE8/RLE4 stream -> bottom-up (height, width) palette indices, runs expanded all at once'
+    fills, copies = rle_runs(data, width, height, bit_count)
+    indices = np.zeros(width * height, np.uint8)
+    if fills:
+        dest, counts, values = runs_array(fills).T
+        positions, inside = ragged_arange(dest, counts)
+        values = np.repeat(values.astype(np.uint8), counts)
+        if bit_count == 4:
+            values = np.where(inside & 1, values & 0x0F, values >> 4)
+        indices[positions] = values
+    if copies:
+        dest, counts, sources = runs_array(copies).T
+        positions, inside = ragged_arange(dest, counts)
+        source = np.frombuffer(data, np.uint8)
+        if bit_count == 8:
+            indices[positions] = source.take(np.repeat(sources, counts) + inside, mode='clip')
+        else:
+            values = source.take(np.repeat(sources, counts) + (inside >> 1), mode='clip')
+            indices[positions] = np.where(inside & 1, values & 0x0F, values >> 4)
+    return indices.reshape(height, width)
+
+def read_pixels(f: BufferedReader, info: BitmapInfo):
+    'Pixel data at the current position, any bit count and compression -> top-down H x W x 3 RGB'
+    compression = info.compression
+    if compression in (BiCompression.BI_RLE8, BiCompression.BI_RLE4):
+        bit_count = 8 if compression is BiCompression.BI_RLE8 else 4
+        if info.bit_count != bit_count:
+            raise ValueError(f'Bit Count Error, {compression.name} Needs {bit_count} Bits, Read({info.bit_count})')
+        data = f.read(info.size_image) if info.size_image else f.read()
+        indices = decode_rle(data, info.width, abs(info.height), bit_count)
+        if info.height > 0:
+            indices = indices[::-1]
+    elif compression in (BiCompression.BI_BITFIELDS, BiCompression.BI_ALPHABITFIELDS):
+        return decode_bitfields(read_rows(f, info), info)
+    elif compression is not BiCompression.BI_RGB:
+        raise ValueError(f'Compression Error, Unsupported {compression.name}')
+    elif info.bit_count == 24:
+        return read_data(f, info.width, info.height)
+    elif info.bit_count in DEFAULT_MASKS:
+        return decode_bitfields(read_rows(f, info), info)
+    else:
+        indices = unpack_indices(read_rows(f, info), info.width, info.bit_count)
+    # 调色板查表，越界的索引取最后一项
+    return info.palette.take(indices, axis=0, mode='clip')
+
 def read_file(path: str):
+    observer = get_observer()
     with open(path, 'rb') as f:
         # file header 14bytes
         bfType, bfSize, bfOffBits = read_header(f)
-        print(BfType(bfType), f'File Size: {bfSize}', f'Data Offset: {bfOffBits}')
-        # bitmap infomation 40bytes
-        biSizeImage, biWidth, biHeight = read_info(f)
-        # print(biSize, biWidth, biHeight, biCompression, biBitCount, biSizeImage)
-        if biSizeImage % 4 != 0:
-            print(f'SizeImage Error: {biSizeImage} % 4 != 0')
+        # bitmap infomation + 掩码 + 调色板
+        info = read_bitmap_info(f)
+        observer.event('bmp_header', type=BfType(bfType).name, size=bfSize, offset=bfOffBits
+                       , width=info.width, height=info.height, bit_count=info.bit_count
+                       , compression=info.compression.name)
+        f.seek(bfOffBits)
+        if info.size_image % 4 != 0:
+            observer.event('warning', message=f'SizeImage Error: {info.size_image} % 4 != 0')
         # bitmap data
-        return read_data(f, biWidth, biHeight), biWidth, biHeight
+        with observer.span('bmp_read_data'):
+            pixels = read_pixels(f, info)
+        observer.count('bytes_read', pixels.nbytes)
+        return Raster.from_array(pixels), info.width, abs(info.height)
+
+class MappedBmp:
+    'Memory-mapped BMP, only the rows and byte ranges that are requested get read'
+    def __init__(self, path: str) -> None:
+        self.file = open(path, 'rb')
+        bfType, bfSize, bfOffBits = read_header(self.file)
+        info = read_bitmap_info(self.file)
+        if info.bit_count != 24 or info.compression is not BiCompression.BI_RGB:
+            self.file.close()
+            raise ValueError(f'Map Error, Only 24-bit BI_RGB, Read({info.bit_count}-bit {info.compression.name})')
+        biWidth, biHeight = info.width, info.height
+        self.width = biWidth
+        self.height = abs(biHeight)
+        self.bottom_up = biHeight > 0
+        self.stride = (biWidth * 3 + 3) // 4 * 4
+        self.map = mmap(self.file.fileno(), 0, access=ACCESS_READ)
+        if bfOffBits + self.stride * self.height > len(self.map):
+            self.close()
+            raise ValueError(f'Data Length Error, Expect({self.stride * self.height}), Read({len(self.map) - bfOffBits})')
+        # 不复制数据，只是按行跨度映射的视图
+        self.data = np.frombuffer(self.map, np.uint8, count=self.stride * self.height, offset=bfOffBits) \
+            .reshape(self.height, self.stride)
+
+    def row(self, y: int):
+        'One RGB row (top-down index) as a view of the mapping'
+        if self.bottom_up:
+            y = self.height - 1 - y
+        return self.data[y, :self.width * 3].reshape(self.width, 3)[:, ::-1]
+
+    def read_region(self, x: int, y: int, w: int, h: int):
+        'Copy out a w x h RGB window whose top-left pixel is (x, y)'
+        if x < 0 or y < 0 or w <= 0 or h <= 0 or x + w > self.width or y + h > self.height:
+            raise ValueError(f'Region Error, ({x}, {y}, {w}, {h}) out of {self.width} x {self.height}')
+        if self.bottom_up:
+            rows = self.data[self.height - y - h: self.height - y][::-1]
+        else:
+            rows = self.data[y: y + h]
+        return np.ascontiguousarray(rows[:, x * 3: (x + w) * 3].reshape(h, w, 3)[:, :, ::-1])
+
+    def __iter__(self):
+        for y in range(self.height):
+            yield np.ascontiguousarray(self.row(y))
+
+    def close(self):
+        self.data = None
+        self.map.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
 
 
 # Write
+def write_header(f: BufferedWriter, biWidth, biHeight):
+    # file header 14bytes + bitmap infomation 40bytes，biHeight < 0 表示自上而下存储
+    stride = (biWidth * 3 + 3) // 4 * 4
+    biSizeImage = stride * abs(biHeight)
+    f.write(pack('<2siHHiiiihhiiiiii'
+                 , BfType.BM.value, 54 + biSizeImage, 0, 0, 54                 # 文件类型、文件大小、保留、数据偏移量
+                 , 40, biWidth, biHeight, 1, 24, BiCompression.BI_RGB.value    # 信息头大小、宽、高、颜色平面数、像素位宽、压缩类型
+                 , biSizeImage, 2835, 2835, 0, 0))                             # 图像大小、水平/垂直分辨率（72 DPI）、颜色索引数
+
+def write_data(f: BufferedWriter, strips, biWidth, biHeight):
+    # strips: 按从上到下的顺序给出的 (n, biWidth, 3) RGB 行块
+    # 自下而上存储时，每个行块直接写到它在文件中的位置，不需要缓存整幅图像
+    height = abs(biHeight)
+    stride = (biWidth * 3 + 3) // 4 * 4
+    start = f.tell()
+    top = 0
+    for strip in strips:
+        strip = np.asarray(strip, np.uint8)
+        if strip.ndim == 2:
+            strip = np.repeat(strip[:, :, np.newaxis], 3, axis=2)
+        count = len(strip)
+        if top + count > height or strip.shape[1:] != (biWidth, 3):
+            raise ValueError(f'Strip Error, Shape{strip.shape} at Row {top}, Image({biWidth} x {height})')
+        rows = np.zeros((count, stride), np.uint8)
+        # RGB -> BGR
+        rows[:, :biWidth * 3] = strip[:, :, ::-1].reshape(count, biWidth * 3)
+        if biHeight > 0:
+            f.seek(start + (height - top - count) * stride)
+            rows = rows[::-1]
+        f.write(rows.tobytes())
+        top += count
+    if top != height:
+        raise ValueError(f'Data Length Error, Expect({height}) Rows, Write({top})')
+    f.seek(start + height * stride)
+
+def write_file(path: str, pixels, biWidth=None, biHeight=None, top_down=False):
+    # pixels 为 H x W x 3 的完整缓冲区（ndarray或Raster），或者行块迭代器（此时需要给出宽高）
+    if isinstance(pixels, Raster):
+        pixels = np.asarray(pixels)
+    if isinstance(pixels, np.ndarray):
+        biHeight, biWidth = pixels.shape[:2]
+        pixels = [pixels]
+    elif biWidth is None or biHeight is None:
+        raise ValueError('Write Error, Width and Height are required for strips')
+    if top_down:
+        biHeight = -biHeight
+    with get_observer().span('bmp_write_data', path=path), open(path, 'wb') as f:
+        write_header(f, biWidth, biHeight)
+        write_data(f, pixels, biWidth, biHeight)
 
 if __name__ == '__main__':
     pixels, biWidth, biHeight = read_file(f'./img/suey.bmp')
     # draw
-    img = PIL.Image.new('RGB', (biWidth, biHeight))
-    img.putdata(pixels)
-    img.show()
+    pixels.to_image().show()
 
@@ -0,0 +1,163 @@
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import threading
+
+import numpy as np
+
+import bmp
+from instrument import get_observer
+from jpeg_decoder import Jpeg
+
+DISK_FORMATS = ('npy', 'raw')
+
+def content_key(path: str, kind: str, **options) -> str:
+    'Hash of the file content plus the decode options, so renamed or copied files share one entry'
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    suffix = '_'.join(f'{name}={options[name]}' for name in sorted(options))
+    return f'{digest.hexdigest()}_{kind}_{suffix}' if suffix else f'{digest.hexdigest()}_{kind}'
+
+class DecodeCache:
+    'Decoded rasters keyed by content hash, in-memory LRU bounded by bytes with an optional on-disk spill tier'
+    # max_bytes     内存中像素数据的总字节数上限
+    # directory     溢出目录，None表示不落盘；内存中被淘汰的条目写入该目录，之后通过mmap读回
+    # disk_format   'npy' 或 'raw'（raw另存一个json记录形状和类型）
+    # 缓存中的数组都是只读的，需要修改时请先复制
+    def __init__(self, max_bytes: int = 256 << 20, directory: str = None, disk_format: str = 'npy') -> None:
+        if disk_format not in DISK_FORMATS:
+            raise ValueError(f'Disk Format Error, Expect one of {DISK_FORMATS}, Read({disk_format})')
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.disk_format = disk_format
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.spills = 0
+        self.lock = threading.Lock()
+
+    def decode_jpeg(self, path: str, scale: float = 1, upsampling: str = 'fancy', workers: int = 1):
+        'Cached Jpeg(path, ...).pixels as an array'
+        key = content_key(path, 'jpeg', scale=scale, upsampling=upsampling)
+        return self.get_or_decode(key, lambda: np.asarray(Jpeg(path, workers, scale=scale
+                                                               , upsampling=upsampling).pixels))
+
+    def read_bmp(self, path: str):
+        'Cached bmp.read_file(path) -> (pixels, width, height)'
+        pixels = self.get_or_decode(content_key(path, 'bmp'), lambda: np.asarray(bmp.read_file(path)[0]))
+        return pixels, pixels.shape[1], pixels.shape[0]
+
+    def get_or_decode(self, key: str, decode):
+        pixels = self.get(key)
+        if pixels is None:
+            pixels = decode()
+            self.put(key, pixels)
+        return pixels
+
+    def get(self, key: str):
+        observer = get_observer()
+        with self.lock:
+            pixels = self.entries.get(key)
+            if pixels is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                observer.count('cache_hits')
+                return pixels
+        pixels = self.load(key)
+        with self.lock:
+            if pixels is not None:
+                self.disk_hits += 1
+                observer.count('cache_disk_hits')
+            else:
+                self.misses += 1
+                observer.count('cache_misses')
+        return pixels
+
+    def put(self, key: str, pixels: np.ndarray):
+        pixels = np.asarray(pixels)
+        pixels.flags.writeable = False
+        if pixels.nbytes > self.max_bytes:
+            # 超过整个内存预算的图像直接落盘
+            self.spill(key, pixels)
+            return
+        evicted = []
+        with self.lock:
+            if key in self.entries:
+                self.bytes -= self.entries.pop(key).nbytes
+            self.entries[key] = pixels
+            self.bytes += pixels.nbytes
+            while self.bytes > self.max_bytes:
+                old_key, old_pixels = self.entries.popitem(last=False)
+                self.bytes -= old_pixels.nbytes
+                self.evictions += 1
+                evicted.append((old_key, old_pixels))
+        if evicted:
+            get_observer().count('cache_evictions', len(evicted))
+        for old_key, old_pixels in evicted:
+            self.spill(old_key, old_pixels)
+
+    def disk_path(self, key: str) -> str:
+        return os.path.join(self.directory, f'{key}.{self.disk_format}')
+
+    def spill(self, key: str, pixels: np.ndarray):
+        # 从磁盘读回的mmap数组本身就在磁盘上，不需要再写
+        if not self.directory or isinstance(pixels, np.memmap) or os.path.exists(self.disk_path(key)):
+            return
+        path = self.disk_path(key)
+        temp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        # 先写临时文件再改名，并发读取时不会读到写了一半的文件
+        if self.disk_format == 'npy':
+            with open(temp, 'wb') as f:
+                np.save(f, pixels)
+        else:
+            # json要在数据文件改名之前就位，load()以数据文件存在为准
+            with open(f'{temp}.json', 'w', encoding='utf-8') as f:
+                json.dump({'shape': pixels.shape, 'dtype': pixels.dtype.str}, f)
+            os.replace(f'{temp}.json', f'{path}.json')
+            with open(temp, 'wb') as f:
+                f.write(np.ascontiguousarray(pixels).tobytes())
+        os.replace(temp, path)
+        with self.lock:
+            self.spills += 1
+
+    def load(self, key: str):
+        'Map a spilled raster back without copying, None when it is not on disk'
+        if not self.directory:
+            return None
+        path = self.disk_path(key)
+        if not os.path.exists(path):
+            return None
+        if self.disk_format == 'npy':
+            return np.load(path, mmap_mode='r')
+        with open(f'{path}.json', encoding='utf-8') as f:
+            header = json.load(f)
+        return np.memmap(path, np.dtype(header['dtype']), 'r', shape=tuple(header['shape']))
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'spills': self.spills,
+                'hit_rate': (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+            }
+
+    def clear(self):
+        'Drop the in-memory tier, spilled files are kept'
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
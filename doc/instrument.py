@@ -0,0 +1,157 @@
+from contextlib import contextmanager, nullcontext
+import json
+import threading
+import time
+
+class Observer:
+    'Receives timing spans, counters and events from the codecs; this base class ignores everything'
+    # enabled 为 False 时调用方直接跳过计数，热路径上只多一次属性判断
+    enabled = False
+
+    def span(self, name: str, **fields):
+        return NULL_SPAN
+
+    def count(self, name: str, value: int = 1):
+        pass
+
+    def event(self, name: str, **fields):
+        pass
+
+NULL_SPAN = nullcontext()
+NULL_OBSERVER = Observer()
+_observer = NULL_OBSERVER
+
+def get_observer() -> Observer:
+    return _observer
+
+def set_observer(observer: Observer = None) -> Observer:
+    'Install observer globally (None disables instrumentation), return the previous one'
+    global _observer
+    previous = _observer
+    _observer = observer or NULL_OBSERVER
+    return previous
+
+@contextmanager
+def observe(observer: Observer):
+    'Install observer for the duration of a with block'
+    previous = set_observer(observer)
+    try:
+        yield observer
+    finally:
+        set_observer(previous)
+
+class Recorder(Observer):
+    'Keeps every span, counter and event in memory, thread-safe'
+    enabled = True
+
+    def __init__(self) -> None:
+        # spans     (name, parent, start, duration, fields)，parent 为外层span的名称
+        self.spans = []
+        self.counters = {}
+        self.events = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    @contextmanager
+    def span(self, name: str, **fields):
+        stack = self.local.__dict__.setdefault('stack', [])
+        parent = stack[-1] if stack else None
+        stack.append(name)
+        start = time.perf_counter()
+        try:
+            yield self
+        finally:
+            duration = time.perf_counter() - start
+            stack.pop()
+            self.record_span(name, parent, start, duration, fields)
+
+    def record_span(self, name, parent, start, duration, fields):
+        with self.lock:
+            self.spans.append((name, parent, start, duration, fields))
+
+    def count(self, name: str, value: int = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def event(self, name: str, **fields):
+        with self.lock:
+            self.events.append((name, time.perf_counter(), fields))
+
+    def totals(self) -> dict:
+        'Span name -> [calls, own time, cumulative time], own time excludes nested spans'
+        totals = {}
+        for name, parent, _, duration, _ in self.spans:
+            entry = totals.setdefault(name, [0, 0.0, 0.0])
+            entry[0] += 1
+            entry[1] += duration
+            entry[2] += duration
+            if parent is not None:
+                totals.setdefault(parent, [0, 0.0, 0.0])[1] -= duration
+        return totals
+
+    def create_stats(self):
+        # pstats.Stats(recorder) 通过 create_stats()/stats 读取，格式与 cProfile 相同：
+        # (文件, 行号, 函数名) -> (原始调用次数, 调用次数, 自身耗时, 累计耗时, {调用者: 同样的四元组})
+        stats = {}
+        for name, (calls, own, cumulative) in self.totals().items():
+            stats[('stage', 0, name)] = (calls, calls, own, cumulative, {})
+        for name, parent, _, duration, _ in self.spans:
+            if parent is None:
+                continue
+            callers = stats[('stage', 0, name)][4]
+            calls, _, own, cumulative = callers.get(('stage', 0, parent), (0, 0, 0.0, 0.0))
+            callers[('stage', 0, parent)] = (calls + 1, calls + 1, own + duration, cumulative + duration)
+        self.stats = stats
+
+    def summary(self, sort: str = 'cumulative', limit: int = None) -> str:
+        'cProfile-style text table of the spans followed by the counters'
+        rows = sorted(self.totals().items(), key=lambda item: item[1][2 if sort == 'cumulative' else 1]
+                      , reverse=True)
+        lines = [f'{"ncalls":>8} {"tottime":>10} {"percall":>10} {"cumtime":>10} {"percall":>10} name']
+        for name, (calls, own, cumulative) in rows[:limit]:
+            lines.append(f'{calls:>8} {own:>10.4f} {own / calls:>10.4f} {cumulative:>10.4f} '
+                         f'{cumulative / calls:>10.4f} {name}')
+        for name, value in sorted(self.counters.items()):
+            lines.append(f'{name}: {value}')
+        return '\n'.join(lines)
+
+    def export_jsonl(self, f):
+        'Write one JSON object per span and event, then one per counter'
+        for name, parent, start, duration, fields in self.spans:
+            f.write(json.dumps({'type': 'span', 'name': name, 'parent': parent, 'start': start
+                                , 'duration': duration, **fields}, default=str) + '\n')
+        for name, timestamp, fields in self.events:
+            f.write(json.dumps({'type': 'event', 'name': name, 'time': timestamp, **fields}, default=str) + '\n')
+        for name, value in self.counters.items():
+            f.write(json.dumps({'type': 'counter', 'name': name, 'value': value}) + '\n')
+
+    def dump_stats(self, path: str):
+        'Save in the binary pstats format, readable by pstats / snakeviz'
+        import pstats
+        pstats.Stats(self).dump_stats(path)
+
+class JsonLinesObserver(Recorder):
+    'Streams spans and events to a text file as JSON lines while they happen, counters are written by close()'
+    def __init__(self, f) -> None:
+        super().__init__()
+        self.file = f
+
+    def record_span(self, name, parent, start, duration, fields):
+        line = json.dumps({'type': 'span', 'name': name, 'parent': parent, 'start': start
+                           , 'duration': duration, **fields}, default=str)
+        with self.lock:
+            self.spans.append((name, parent, start, duration, fields))
+            self.file.write(line + '\n')
+
+    def event(self, name: str, **fields):
+        timestamp = time.perf_counter()
+        line = json.dumps({'type': 'event', 'name': name, 'time': timestamp, **fields}, default=str)
+        with self.lock:
+            self.events.append((name, timestamp, fields))
+            self.file.write(line + '\n')
+
+    def close(self):
+        with self.lock:
+            for name, value in self.counters.items():
+                self.file.write(json.dumps({'type': 'counter', 'name': name, 'value': value}) + '\n')
+            self.file.flush()
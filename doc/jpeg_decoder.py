@@ -57,19 +57,33 @@
 # ...   ...
 # RES   0xFFBF                              保留，共189个
 
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from enum import Enum
-from struct import unpack
+from io import BufferedReader
+from itertools import repeat
+from math import ceil
+from mmap import ACCESS_READ, mmap
+import os
+from struct import calcsize, pack, unpack_from
+from threading import Lock
+from zlib import crc32
+
+import numpy as np
+
+from instrument import get_observer
+from raster import Raster
 
 class SOI:
     'Start of image'
     def __init__(self, segment: bytes) -> None:
-        if segment != [0xD8]:
+        if bytes(segment) != b'\xD8':
             raise ValueError("SOI Read Error")
 
 class EOI:
     'End of Image'
     def __init__(self, segment: bytes) -> None:
-        if segment != [0xD9]:
+        if bytes(segment) != b'\xD9':
             raise ValueError("EOI Read Error")
 
 class APP0:
@@ -96,14 +110,14 @@ class APP0:
     # 这是一个24bits/pixel的RGB位图
     def __init__(self, segment: bytes) -> None:
         _ = segment[0]  # marker
-        self.length = unpack('>H', bytes(segment[1:3]))[0]
-        self.identifier = unpack('5s', bytes(segment[3:8]))
-        self.version = unpack('>H', bytes(segment[8:10]))[0]
-        self.unit = APP0.DensityUnit(unpack('B', bytes(segment[10:11]))[0])
-        self.density_row = unpack('>H', bytes(segment[11:13]))[0]
-        self.density_col = unpack('>H', bytes(segment[13:15]))[0]
-        self.thumbnail_row = unpack('B', bytes(segment[15:16]))[0]
-        self.thumbnail_col = unpack('B', bytes(segment[16:17]))[0]
+        self.length = unpack_from('>H', segment, 1)[0]
+        self.identifier = unpack_from('5s', segment, 3)
+        self.version = unpack_from('>H', segment, 8)[0]
+        self.unit = APP0.DensityUnit(unpack_from('B', segment, 10)[0])
+        self.density_row = unpack_from('>H', segment, 11)[0]
+        self.density_col = unpack_from('>H', segment, 13)[0]
+        self.thumbnail_row = unpack_from('B', segment, 15)[0]
+        self.thumbnail_col = unpack_from('B', segment, 16)[0]
         self.thumbnail = segment[17:]
         if len(self.thumbnail) != self.thumbnail_row * self.thumbnail_col * 3:
             raise ValueError('thumbnail Length Error')
@@ -126,7 +140,7 @@ class APPn:
     #       Exif使用APP1来存放图片的metadata
     #       Adobe Photoshop用APP1和APP13两个标记段分别存储了一副图像的副本
     def __init__(self, segment: bytes) -> None:
-        print('APPn Len:', len(segment))
+        get_observer().event('segment', marker=hex(segment[0]), length=len(segment))
 
 class SOF0:
     'Start of Frame0 Baseline DCT-based JPEG'
@@ -142,11 +156,11 @@ class SOF0:
     #       1 byte 当前分量使用的量化表ID
     def __init__(self, segment: bytes) -> None:
         _ = segment[0]  # marker
-        self.length = unpack('>H', bytes(segment[1:3]))[0]
-        self.degree = unpack('B', bytes(segment[3:4]))[0]
-        self.height = unpack('>H', bytes(segment[4:6]))[0]
-        self.width = unpack('>H', bytes(segment[6:8]))[0]
-        self.vector_count = unpack('B', bytes(segment[8:9]))[0]
+        self.length = unpack_from('>H', segment, 1)[0]
+        self.degree = unpack_from('B', segment, 3)[0]
+        self.height = unpack_from('>H', segment, 4)[0]
+        self.width = unpack_from('>H', segment, 6)[0]
+        self.vector_count = unpack_from('B', segment, 8)[0]
         self.dqt_map = []
         self.factor = []
         for count in range(self.vector_count):
@@ -186,8 +200,8 @@ class DHT:
     #       编码内容  上述16个不同位数的码字的数量和 bytes
     def __init__(self, segment: bytes) -> None:
         _ = segment[0]  # marker
-        self.length = unpack('>H', bytes(segment[1:3]))[0]
-        value = unpack('B', bytes(segment[3:4]))[0]
+        self.length = unpack_from('>H', segment, 1)[0]
+        value = unpack_from('B', segment, 3)[0]
         self.id = value & 0x0F
         self.table_type = DHT.TableType(value >> 4)
         self.counts = segment[4:20]
@@ -253,13 +267,15 @@ class DQT:
     #           16bits  64 * (1 + 1)bytes 128 bytes
     def __init__(self, segment: bytes) -> None:
         _ = segment[0]  # marker
-        self.length = unpack('>H', bytes(segment[1:3]))[0]
-        value = unpack('B', bytes(segment[3:4]))[0]
+        self.length = unpack_from('>H', segment, 1)[0]
+        value = unpack_from('B', segment, 3)[0]
         self.id = value & 0x0F
         self.degree = QuantizationDegree(value >> 4)
         self.table = segment[4:4 + 64 * (self.degree.value + 1)]
         if self.length != 3 + len(self.table):
             raise ValueError(f'DQT Length Error, Expect({self.length}), Read({3 + len(self.table)})')
+        # 表项，zig-zag顺序
+        self.values = np.frombuffer(self.table, dtype=np.uint8 if self.degree is QuantizationDegree.Bits8 else '>u2')
 
     def print(self):
         print(f'===== DQT =====')
@@ -274,8 +290,8 @@ class DRI:
     #   第一个标记是RST0，第二个是RST1等，RST7后再从RST0重复。
     def __init__(self, segment: bytes) -> None:
         _ = segment[0]  # marker
-        self.length = unpack('>H', bytes(segment[1:3]))[0]
-        self.interval = unpack('>H', bytes(segment[3:5]))[0]
+        self.length = unpack_from('>H', segment, 1)[0]
+        self.interval = unpack_from('>H', segment, 3)[0]
         if self.length != 4:
             raise ValueError(f'DRI Length Error, Expect({self.length}), Read(4)')
 
@@ -294,13 +310,13 @@ class SOS:
     #           高4位：直流分量使用的哈夫曼树编号（direct-current）
     #           低4位：交流分量使用的哈夫曼树编号(alternating-current)
     # 压缩图像信息  3bytes
-    #       1 byte 谱选择开始 固定为0x00
-    #       1 byte 谱选择结束 固定为0x3f
-    #       1 byte 谱选择 在basic JPEG中固定为00
-    def __init__(self, segment: bytes) -> None:
+    #       1 byte 谱选择开始 固定为0x00（渐进式：本次扫描的第一个zig-zag系数 Ss）
+    #       1 byte 谱选择结束 固定为0x3f（渐进式：本次扫描的最后一个zig-zag系数 Se）
+    #       1 byte 谱选择 在basic JPEG中固定为00（渐进式：高4位Ah为上次扫描的逐次逼近位，低4位Al为本次）
+    def __init__(self, segment: bytes, progressive: bool = False) -> None:
         _ = segment[0]  # marker
-        self.length = unpack('>H', bytes(segment[1:3]))[0]
-        self.vector_count = unpack('B', bytes(segment[3:4]))[0]
+        self.length = unpack_from('>H', segment, 1)[0]
+        self.vector_count = unpack_from('B', segment, 3)[0]
         self.dht_map = []
         for count in range(self.vector_count):
             vector_id = segment[4 + count * 2]
@@ -311,7 +327,14 @@ class SOS:
         self.thumbnail_spectrum_start = segment[4 + self.vector_count * 2]
         self.thumbnail_spectrum_end = segment[5 + self.vector_count * 2]
         self.thumbnail_spectrum_select = segment[6 + self.vector_count * 2]
-        if self.thumbnail_spectrum_start != 0x00 \
+        self.approximation_high = self.thumbnail_spectrum_select >> 4
+        self.approximation_low = self.thumbnail_spectrum_select & 0x0F
+        if progressive:
+            if self.thumbnail_spectrum_start > self.thumbnail_spectrum_end or self.thumbnail_spectrum_end > 0x3F \
+                    or (self.thumbnail_spectrum_start == 0) != (self.thumbnail_spectrum_end == 0) \
+                    or (self.thumbnail_spectrum_start and self.vector_count != 1):
+                raise ValueError('Progressive Spectrum Error')
+        elif self.thumbnail_spectrum_start != 0x00 \
             or self.thumbnail_spectrum_end != 0x3F:
                 raise ValueError('Thumbnail Spectrum Error')
         if self.length != 6 + self.vector_count * 2:
@@ -327,12 +350,330 @@ class SOS:
 class COM:
     'Comment'
     def __init__(self, segment: bytes) -> None:
-        print('COM Len:', len(segment))
+        get_observer().event('segment', marker='0xfe', length=len(segment))
+
+class HuffmanTable:
+    'Canonical Huffman decode table built from DHT'
+    # maxcode[l]    码长为l的最大码字，-1表示没有该码长的码字（maxcode[17]为哨兵）
+    # mincode[l]    码长为l的最小码字
+    # valptr[l]     码长为l的第一个码字在values中的下标
+    # lookup        LOOKAHEAD位前缀 -> (码长 << 8) | 权值，0表示码长超过LOOKAHEAD，走慢速路径
+    LOOKAHEAD = 9
+    LOOKAHEAD_MASK = (1 << LOOKAHEAD) - 1
+
+    def __init__(self, counts: list, values: list) -> None:
+        self.values = bytes(values)
+        self.maxcode = [-1] * 18
+        self.mincode = [0] * 17
+        self.valptr = [0] * 17
+        self.lookup = [0] * (1 << HuffmanTable.LOOKAHEAD)
+        code = 0
+        index = 0
+        for length in range(1, 17):
+            count = counts[length - 1]
+            if count:
+                self.valptr[length] = index
+                self.mincode[length] = code
+                self.maxcode[length] = code + count - 1
+                if length <= HuffmanTable.LOOKAHEAD:
+                    shift = HuffmanTable.LOOKAHEAD - length
+                    for offset in range(count):
+                        entry = (length << 8) | self.values[index + offset]
+                        start = (code + offset) << shift
+                        self.lookup[start: start + (1 << shift)] = [entry] * (1 << shift)
+                code += count
+                index += count
+            code <<= 1
+        self.maxcode[17] = 0x7FFFFFFF
+
+class QuantizationTable:
+    'Dequantization multipliers built from DQT, in natural order for every scaled block size'
+    # scaled[size]  左上角 size x size 的量化表项（float32），与 ZIGZAG_CORNER[size] 取出的系数一一对应
+    def __init__(self, values: np.ndarray) -> None:
+        self.values = values
+        table = np.asarray(values, dtype=np.float32)
+        self.scaled = {size: table[index] for size, index in ZIGZAG_CORNER.items()}
+
+class TableCache:
+    'Process-wide LRU of parsed and compiled DHT/DQT segments keyed by their raw bytes, thread-safe'
+    def __init__(self, max_entries: int = 256) -> None:
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = Lock()
+
+    def get(self, segment, build):
+        # 缓存的对象只引用复制出来的bytes，不会让文件缓冲区（或mmap）一直存活
+        key = bytes(segment)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                get_observer().count('table_cache_hits')
+                return entry
+            self.misses += 1
+        get_observer().count('table_cache_misses')
+        entry = build(key)
+        with self.lock:
+            self.entries[key] = entry
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return entry
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses}
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+TABLE_CACHE = TableCache()
+
+def build_dht(segment: bytes) -> DHT:
+    dht = DHT(segment)
+    dht.decoder = HuffmanTable(dht.counts, dht.weights)
+    return dht
+
+def build_dqt(segment: bytes) -> DQT:
+    dqt = DQT(segment)
+    dqt.decoder = QuantizationTable(dqt.values)
+    return dqt
+
+def compiled_dht(segment) -> DHT:
+    'DHT with its HuffmanTable in .decoder, shared by every file that carries the same segment'
+    return TABLE_CACHE.get(segment, build_dht)
+
+def compiled_dqt(segment) -> DQT:
+    'DQT with its QuantizationTable in .decoder, shared by every file that carries the same segment'
+    return TABLE_CACHE.get(segment, build_dqt)
+
+class BitReader:
+    'MSB-first bit reader over entropy-coded scan bytes, refilled 64 bits at a time'
+    # 哈夫曼查表次数，只有CountingBitReader会计数
+    lookups = 0
+
+    def __init__(self, data: bytes) -> None:
+        self.data = bytes(data)
+        self.total = len(self.data) * 8
+        self.pos = 0
+        self.acc = 0
+        self.nbits = 0
+
+    def fill(self):
+        # 读完后补0，由调用方通过overrun()丢弃不完整的数据单元
+        word = int.from_bytes(self.data[self.pos: self.pos + 8].ljust(8, b'\x00'), 'big')
+        self.acc = ((self.acc & ((1 << self.nbits) - 1)) << 64) | word
+        self.nbits += 64
+        self.pos += 8
+
+    def consumed(self):
+        return self.pos * 8 - self.nbits
+
+    def remaining(self):
+        return self.total - self.consumed()
+
+    def overrun(self):
+        return self.consumed() > self.total
+
+    def decode(self, table: HuffmanTable):
+        if self.nbits < 32:
+            self.fill()
+        entry = table.lookup[(self.acc >> (self.nbits - HuffmanTable.LOOKAHEAD)) & HuffmanTable.LOOKAHEAD_MASK]
+        if entry:
+            self.nbits -= entry >> 8
+            return entry & 0xFF
+        length = HuffmanTable.LOOKAHEAD + 1
+        code = (self.acc >> (self.nbits - length)) & ((1 << length) - 1)
+        while code > table.maxcode[length]:
+            length += 1
+            if length > 16:
+                raise ValueError('Decode Huffman Error, ReadCode Length > 16')
+            code = (self.acc >> (self.nbits - length)) & ((1 << length) - 1)
+        self.nbits -= length
+        return table.values[table.valptr[length] + code - table.mincode[length]]
+
+    def bits(self, width):
+        'Next width bits as an unsigned integer'
+        if self.nbits < width:
+            self.fill()
+        self.nbits -= width
+        return (self.acc >> self.nbits) & ((1 << width) - 1)
+
+    def receive_extend(self, width):
+        # decode()保证缓冲区至少还有16位
+        self.nbits -= width
+        data = (self.acc >> self.nbits) & ((1 << width) - 1)
+        if data < (1 << (width - 1)):
+            data -= (1 << width) - 1
+        return data
+
+class CountingBitReader(BitReader):
+    'BitReader that also counts Huffman table lookups, used only while instrumentation is enabled'
+    def decode(self, table: HuffmanTable):
+        self.lookups += 1
+        return BitReader.decode(self, table)
+
+def decode_unit(reader: BitReader, dc_table: HuffmanTable, ac_table: HuffmanTable, dc_base: int
+                , unit: memoryview, offset: int = 0):
+    # 直流哈夫曼表权值（共8位）：
+    #   表示该直流分量值的二进制位数，也就是接下来需要读入的位数。
+    # 交流哈夫曼表权值（共8位）：
+    #   高4位表示当前数值前面有多少个连续的零
+    #   低4位表示该交流分量数值的二进制位数
+    # unit[offset: offset + 64] 必须预先清零，这里只写入非零系数
+    width = reader.decode(dc_table)
+    if width:
+        dc_base += reader.receive_extend(width)
+    unit[offset] = dc_base
+    index = 1
+    while index < 64:
+        weight = reader.decode(ac_table)
+        width = weight & 0x0F
+        if width:
+            index += weight >> 4
+            if index > 63:
+                raise ValueError('DataUnit Length > 64 ACData')
+            unit[offset + index] = reader.receive_extend(width)
+            index += 1
+        elif weight == 0:
+            break
+        else:
+            index += (weight >> 4) + 1
+            if index > 64:
+                raise ValueError('DataUnit Length > 64 ACCode')
+    return dc_base
+
+def decode_mcus(reader: BitReader, dc_base: list, vector_order: tuple, dc_tables: list, ac_tables: list
+                , units: list, cursors: list, mcu_limit: int):
+    'Decode up to mcu_limit MCUs into the per-component (N, 64) int16 buffers at cursors, return the count'
+    views = [memoryview(unit.reshape(-1)) for unit in units]
+    count = 0
+    while count < mcu_limit and reader.remaining() > 0:
+        start = list(cursors)
+        for current in vector_order:
+            dc_base[current] = decode_unit(reader, dc_tables[current], ac_tables[current], dc_base[current]
+                                           , views[current], cursors[current] * 64)
+            cursors[current] += 1
+        if reader.overrun():
+            # 数据不足一个完整的MCU，丢弃并清零
+            for index, unit in enumerate(units):
+                unit[start[index]: cursors[index]] = 0
+            cursors[:] = start
+            break
+        count += 1
+    return count
+
+def decode_interval(data: bytes, vector_order: tuple, dc_tables: list, ac_tables: list, mcu_count: int
+                    , reader_type: type = BitReader):
+    'Decode one restart interval into fresh buffers -> (units, bits consumed, table lookups)'
+    # 每个分量的DC预测都从0开始
+    units = [np.zeros((mcu_count * vector_order.count(index), 64), np.int16) for index in range(len(dc_tables))]
+    cursors = [0] * len(dc_tables)
+    reader = reader_type(data)
+    decode_mcus(reader, [0] * len(dc_tables), vector_order, dc_tables, ac_tables, units, cursors, mcu_count)
+    return [unit[:cursor] for unit, cursor in zip(units, cursors)], min(reader.consumed(), reader.total), reader.lookups
+
+# 渐进式JPEG（SOF2）：系数按谱选择（Ss~Se）和逐次逼近（Ah/Al）分多次扫描写入同一个缓冲区
+# 每个函数处理一个数据单元，unit[offset: offset + 64] 为zig-zag顺序的系数，eobrun为连续全零块（EOB）的剩余数量
+def decode_dc_first(reader: BitReader, table: HuffmanTable, dc_base: int, unit: memoryview, offset: int, al: int):
+    width = reader.decode(table)
+    if width:
+        dc_base += reader.receive_extend(width)
+    unit[offset] = dc_base << al
+    return dc_base
+
+def decode_dc_refine(reader: BitReader, unit: memoryview, offset: int, al: int):
+    if reader.bits(1):
+        unit[offset] |= 1 << al
+
+def decode_ac_first(reader: BitReader, table: HuffmanTable, unit: memoryview, offset: int
+                    , start: int, end: int, al: int, eobrun: int):
+    if eobrun:
+        return eobrun - 1
+    index = start
+    while index <= end:
+        weight = reader.decode(table)
+        run = weight >> 4
+        width = weight & 0x0F
+        if width:
+            index += run
+            if index > end:
+                raise ValueError('DataUnit Length > Se ACData')
+            unit[offset + index] = reader.receive_extend(width) << al
+            index += 1
+        elif run == 15:
+            # ZRL：16个0
+            index += 16
+        else:
+            # EOBn：本块和之后 2^n + 附加位 - 1 个块的剩余系数全为0
+            eobrun = 1 << run
+            if run:
+                eobrun += reader.bits(run)
+            return eobrun - 1
+    return 0
+
+def decode_ac_refine(reader: BitReader, table: HuffmanTable, unit: memoryview, offset: int
+                     , start: int, end: int, al: int, eobrun: int):
+    # 已非零的系数每个读1位修正；新出现的系数只能是 ±1 << al
+    positive = 1 << al
+    negative = -1 << al
+    index = start
+    if not eobrun:
+        while index <= end:
+            weight = reader.decode(table)
+            run = weight >> 4
+            value = 0
+            if weight & 0x0F:
+                value = positive if reader.bits(1) else negative
+            elif run != 15:
+                eobrun = 1 << run
+                if run:
+                    eobrun += reader.bits(run)
+                break
+            # 跳过run个为0的系数，途中经过的非零系数都要修正
+            while index <= end:
+                coefficient = unit[offset + index]
+                if coefficient:
+                    if reader.bits(1) and not coefficient & positive:
+                        unit[offset + index] = coefficient + (positive if coefficient >= 0 else negative)
+                else:
+                    run -= 1
+                    if run < 0:
+                        break
+                index += 1
+            if value and index <= end:
+                unit[offset + index] = value
+            index += 1
+    if eobrun:
+        while index <= end:
+            coefficient = unit[offset + index]
+            if coefficient and reader.bits(1) and not coefficient & positive:
+                unit[offset + index] = coefficient + (positive if coefficient >= 0 else negative)
+            index += 1
+        eobrun -= 1
+    return eobrun
+
+class ScanChunk:
+    'Entropy-coded data between two markers, 0xFF00 is un-stuffed lazily by bytes()'
+    def __init__(self, buffer: memoryview, start: int, end: int) -> None:
+        self.buffer = buffer
+        self.start = start
+        self.end = end
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __bytes__(self):
+        return bytes(self.buffer[self.start: self.end]).replace(b'\xff\x00', b'\xff')
 
 class Frame:
     def __init__(self) -> None:
         self.data = []
         self.units = []
+        self.unit_count = []
         self.huffman_table_direct = []
         self.huffman_table_alternate = []
         self.quantization_table = []
@@ -344,256 +685,766 @@ class Frame:
         self.huffman_table_alternate.append(table)
     def add_quantization_table(self, table):
         self.quantization_table.append(table)
-    def config(self, width, height, factor, dqt_map, dht_map):
+    def config(self, width, height, factor, dqt_map, dht_map, restart_interval=0):
         self.width = width
         self.height = height
         self.factor = factor
         self.dqt_map = dqt_map
         self.dht_map = dht_map
+        self.restart_interval = restart_interval
 
     def get_mcu_order(self):
-        if self.factor == [(1, 2, 2), (2, 1, 1), (3, 1, 1)]:
-            return (0, 0, 0, 0, 1, 2)
-        elif self.factor == [(1, 1, 1), (2, 1, 1), (3, 1, 1)]:
-            return (0, 1, 2)
-        else:
-            raise ValueError('get_mcu_order Error, Unknown Vector Factor')
+        # 交错扫描：每个MCU依次包含各分量的 水平采样 * 垂直采样 个数据单元
+        # 单分量扫描（灰度）：每个MCU只有一个数据单元
+        if len(self.factor) == 1:
+            return (0,)
+        order = []
+        for index, (_, horizontal, vertical) in enumerate(self.factor):
+            order += [index] * (horizontal * vertical)
+        if len(order) > 10:
+            raise ValueError('get_mcu_order Error, MCU Data Units > 10')
+        return tuple(order)
 
     def current_vector_index(self):
-        # Get Vector Index
-        if self.factor == [(1, 2, 2), (2, 1, 1), (3, 1, 1)]:
-            match len(self.units) % 6:
-                case 5:
-                    index = 2
-                case 4:
-                    index = 1
-                case _:
-                    index = 0
-
-        elif self.factor == [(1, 1, 1), (2, 1, 1), (3, 1, 1)]:
-            index = len(self.units) % 3
-        else:
-            raise ValueError('Decode Huffman Error, Unknown Vector Factor')
-        return index
-
-    def push_unit(self, unit):
-        self.units.append(unit)
-
-    def decode_huffman(self):
-        print(f'Frame Counts: {len(self.data)}')
-        print('=== DHT MAP ===\n(ID, DC, AC)')
-        print(self.factor)
-
-        class State(Enum):
-            DCCode = 0
-            DCData = 1
-            ACCode = 2
-            ACData = 3
-        # 直流哈夫曼表权值（共8位）：
-        #   表示该直流分量值的二进制位数，也就是接下来需要读入的位数。
-        # 交流哈夫曼表权值（共8位）：
-        #   高4位表示当前数值前面有多少个连续的零
-        #   低4位表示该交流分量数值的二进制位数
+        vector_order = self.get_mcu_order()
+        return vector_order[sum(self.unit_count) % len(vector_order)]
+
+    def get_mcu_layout(self):
+        'MCU columns, MCU rows, max horizontal factor, max vertical factor'
+        if len(self.factor) == 1:
+            return ceil(self.width / 8), ceil(self.height / 8), 1, 1
+        horizontal_max = max(horizontal for _, horizontal, _ in self.factor)
+        vertical_max = max(vertical for _, _, vertical in self.factor)
+        return ceil(self.width / (8 * horizontal_max)), ceil(self.height / (8 * vertical_max)) \
+            , horizontal_max, vertical_max
+
+    def get_vector_factor(self, index):
+        if len(self.factor) == 1:
+            return 1, 1
+        _, horizontal, vertical = self.factor[index]
+        return horizontal, vertical
+
+    def component_plane(self, index):
+        'Arrange the reconstructed blocks of one component into a 2D sample plane'
+        mcu_cols, mcu_rows, _, _ = self.get_mcu_layout()
+        horizontal, vertical = self.get_vector_factor(index)
+        return tile_blocks(self.samples[index], mcu_rows, mcu_cols, vertical, horizontal)
+
+    def color_convert(self, upsampling: str = 'fancy'):
+        'Upsample chroma planes to full resolution and convert to RGB (or return the gray plane)'
+        _, _, horizontal_max, vertical_max = self.get_mcu_layout()
+        width = ceil(self.width * self.block_size / 8)
+        height = ceil(self.height * self.block_size / 8)
+        planes = []
+        for index in range(len(self.factor)):
+            plane = self.component_plane(index)
+            horizontal, vertical = self.get_vector_factor(index)
+            if horizontal_max % horizontal or vertical_max % vertical:
+                raise ValueError('Color Convert Error, Sample Factor Not Divisible')
+            plane = upsample(plane, vertical_max // vertical, horizontal_max // horizontal, upsampling)
+            planes.append(plane[:height, :width])
+        return planes_to_pixels(planes)
+
+    def get_huffman_tables(self):
+        dc_tables = [self.huffman_table_direct[self.dht_map[index][1]] for index in range(len(self.factor))]
+        ac_tables = [self.huffman_table_alternate[self.dht_map[index][2]] for index in range(len(self.factor))]
+        return dc_tables, ac_tables
+
+    def allocate_units(self, mcu_count: int):
+        'Zeroed int16 coefficient buffers, (mcu_count * H * V, 64) for each component'
+        units = []
+        for index in range(len(self.factor)):
+            horizontal, vertical = self.get_vector_factor(index)
+            units.append(np.zeros((mcu_count * horizontal * vertical, 64), np.int16))
+        return units
+
+    def iter_row_planes(self, block_size: int = 8):
+        'Yield the component planes of one MCU row at a time, decoded into one reused row buffer'
+        mcu_cols, mcu_rows, _, _ = self.get_mcu_layout()
+        vector_order = self.get_mcu_order()
+        dc_tables, ac_tables = self.get_huffman_tables()
+        units = self.allocate_units(mcu_cols)
+        cursors = [0] * len(self.factor)
+        filled = 0
+        row_count = 0
+        observer = get_observer()
+        reader_type = CountingBitReader if observer.enabled else BitReader
+        interval = self.restart_interval or mcu_cols * mcu_rows
         for segment in self.data:
-            data_unit = []
-            state = State.DCCode
-            code = ''
-            width = 0
-            length = 0
-            data = 0
-            dc_base = 0
-            for byte in segment:
-                for offset in range(8):
-                    value = (byte >> (7 - offset)) & 0x01
-                    match state:
-                        case State.DCCode:
-                            code += str(value)
-                            if len(code) > 16:
-                                raise ValueError('Decode Huffman Error, ReadCode Length > 16')
-                            current = self.current_vector_index()
-                            huffman_table = self.huffman_table_direct[self.dht_map[current][1]]
-                            for huffman_entry in huffman_table:
-                                if code == huffman_entry[2]:
-                                    width = huffman_entry[3]
-                                    if width == 0:
-                                        data_unit.append(dc_base)
-                                        state = State.ACCode
-                                        code = ''
-                                    else:
-                                        state = State.DCData
-                                        length = 0
-                                        data = 0
-                                    break
-                        case State.DCData:
-                            data = (data << 1) | value
-                            length += 1
-                            if length >= width:
-                                if (data & (0x01 << (width - 1))) == 0:
-                                    data = - (data | (0x01 << (width - 1)))
-                                dc_base += data
-                                data_unit.append(dc_base)
-                                state = State.ACCode
-                                code = ''
-                        case State.ACCode:
-                            code += str(value)
-                            if len(code) > 16:
-                                raise ValueError('Decode Huffman Error, ReadCode Length > 16')
-                            current = self.current_vector_index()
-                            huffman_table = self.huffman_table_alternate[self.dht_map[current][2]]
-                            for huffman_entry in huffman_table:
-                                if code == huffman_entry[2]:
-                                    if huffman_entry[3] == 0:
-                                        for _ in range(64 - len(data_unit)):
-                                            data_unit.append(0)
-                                        self.push_unit(data_unit)
-                                        state = State.DCCode
-                                        data_unit = []
-                                        code = ''
-                                    else:
-                                        width = huffman_entry[3] & 0x0F
-                                        pad = huffman_entry[3] >> 4
-                                        for _ in range(pad):
-                                            data_unit.append(0)
-                                        if width == 0:
-                                            data_unit.append(0)
-                                            state = State.ACCode
-                                            code = ''
-                                        else:
-                                            state = State.ACData
-                                            length = 0
-                                            data = 0
-                                        if len(data_unit) > 64:
-                                            raise ValueError('DataUnit Length > 64 ACCode')
-                                        elif len(data_unit) == 64:
-                                            self.push_unit(data_unit)
-                                            state = State.DCCode
-                                            data_unit = []
-                                            code = ''
-                                    break
-                        case State.ACData:
-                            data = (data << 1) | value
-                            length += 1
-                            if length >= width:
-                                if (data & (0x01 << (width - 1))) == 0:
-                                    data = - (data | (0x01 << (width - 1)))
-                                data_unit.append(data)
-                                state = State.ACCode
-                                code = ''
-
-                                if len(data_unit) > 64:
-                                    raise ValueError('DataUnit Length > 64 ACData')
-                                elif len(data_unit) == 64:
-                                    self.push_unit(data_unit)
-                                    state = State.DCCode
-                                    data_unit = []
-                                    code = ''
-
-    def decode_quantization(self):
-        print(self.dqt_map)
-        unit_index = 0
+            dc_base = [0] * len(self.factor)
+            reader = reader_type(segment)
+            # 与decode_huffman相同，每段最多解码restart_interval个MCU，段尾的填充位不能当作MCU
+            decoded = 0
+            while row_count < mcu_rows and decoded < interval:
+                limit = min(mcu_cols - filled, interval - decoded)
+                count = decode_mcus(reader, dc_base, vector_order, dc_tables, ac_tables
+                                    , units, cursors, limit)
+                filled += count
+                decoded += count
+                if filled < mcu_cols:
+                    if count < limit:
+                        break
+                    continue
+                if observer.enabled:
+                    observer.count('blocks_decoded', sum(cursors))
+                yield self.reconstruct_row(units, block_size)
+                for unit in units:
+                    unit.fill(0)
+                cursors = [0] * len(self.factor)
+                filled = 0
+                row_count += 1
+            if observer.enabled:
+                observer.count('restart_intervals')
+                observer.count('bits_consumed', min(reader.consumed(), reader.total))
+                observer.count('table_lookups', reader.lookups)
+        if filled:
+            if observer.enabled:
+                observer.count('blocks_decoded', sum(cursors))
+            yield self.reconstruct_row(units, block_size)
+
+    def reconstruct_row(self, units: list, block_size: int = 8):
+        mcu_cols, _, _, _ = self.get_mcu_layout()
+        planes = []
+        for index, unit in enumerate(units):
+            table = self.quantization_table[self.dqt_map[index][1]]
+            samples = idct_blocks(dequantize(unit, table, block_size))
+            horizontal, vertical = self.get_vector_factor(index)
+            planes.append(tile_blocks(samples, 1, mcu_cols, vertical, horizontal))
+        return planes
+
+    def decode_rows(self, block_size: int = 8, upsampling: str = 'fancy'):
+        'Yield decoded pixel strips of one MCU row each, only three MCU rows are kept in memory'
+        _, _, horizontal_max, vertical_max = self.get_mcu_layout()
+        width = ceil(self.width * block_size / 8)
+        height = ceil(self.height * block_size / 8)
+        row_planes = self.iter_row_planes(block_size)
+        previous = None
+        current = next(row_planes, None)
+        top = 0
+        while current is not None and top < height:
+            # 三角滤波需要上下相邻MCU行的各一行色度作为上下文，所以多解码一行
+            following = next(row_planes, None)
+            planes = []
+            for index, plane in enumerate(current):
+                horizontal, vertical = self.get_vector_factor(index)
+                factor = vertical_max // vertical
+                if upsampling == 'fancy' and factor > 1:
+                    above = previous[index][-1:] if previous else plane[:1]
+                    below = following[index][:1] if following else plane[-1:]
+                    plane = np.concatenate((above, plane, below))
+                    plane = upsample(plane, factor, horizontal_max // horizontal, upsampling)[factor: -factor]
+                else:
+                    plane = upsample(plane, factor, horizontal_max // horizontal, upsampling)
+                planes.append(plane[:height - top, :width])
+            strip = planes_to_pixels(planes)
+            top += len(strip)
+            yield strip
+            previous, current = current, following
+
+    def decode_huffman(self, workers: int = 1, executor: str = 'process'):
+        observer = get_observer()
+        reader_type = CountingBitReader if observer.enabled else BitReader
+        bits = 0
+        lookups = 0
+        # 按图像尺寸预先分配系数缓冲区，unit_count为各分量已写入的数据单元数
+        mcu_cols, mcu_rows, _, _ = self.get_mcu_layout()
+        mcu_count = mcu_cols * mcu_rows
+        self.units = self.allocate_units(mcu_count)
+        self.unit_count = [0] * len(self.factor)
         vector_order = self.get_mcu_order()
-        order_length = len(vector_order)
-        for unit in self.units:
-            vector_index = vector_order[unit_index % order_length]
-            table_id = self.dqt_map[vector_index][1]
-            table = self.quantization_table[table_id]
-            unit_index += 1
-            for index in range(64):
-                unit[index] *= table[index]
+        dc_tables, ac_tables = self.get_huffman_tables()
+        if workers > 1 and len(self.data) > 1:
+            # 各RST分段的差分互相独立，可以并行解码后按顺序拼接
+            interval = self.restart_interval or mcu_count
+            pool_type = ProcessPoolExecutor if executor == 'process' else ThreadPoolExecutor
+            with pool_type(max_workers=workers) as pool:
+                results = pool.map(decode_interval
+                                   , [bytes(segment) for segment in self.data]
+                                   , repeat(vector_order)
+                                   , repeat(dc_tables)
+                                   , repeat(ac_tables)
+                                   , repeat(interval)
+                                   , repeat(reader_type)
+                                   , chunksize=max(1, len(self.data) // (workers * 4)))
+                for units, segment_bits, segment_lookups in results:
+                    bits += segment_bits
+                    lookups += segment_lookups
+                    for index, unit in enumerate(units):
+                        count = min(len(unit), len(self.units[index]) - self.unit_count[index])
+                        self.units[index][self.unit_count[index]: self.unit_count[index] + count] = unit[:count]
+                        self.unit_count[index] += count
+        else:
+            # 每段最多解码restart_interval个MCU，避免把段尾的填充位当作下一个MCU
+            blocks = len(vector_order)
+            interval = self.restart_interval or mcu_count
+            for segment in self.data:
+                mcu_limit = min(interval, mcu_count - sum(self.unit_count) // blocks)
+                reader = reader_type(segment)
+                decode_mcus(reader, [0] * len(self.factor), vector_order, dc_tables, ac_tables
+                            , self.units, self.unit_count, mcu_limit)
+                bits += min(reader.consumed(), reader.total)
+                lookups += reader.lookups
+        if observer.enabled:
+            observer.count('restart_intervals', len(self.data))
+            observer.count('blocks_decoded', sum(self.unit_count))
+            observer.count('bits_consumed', bits)
+            observer.count('table_lookups', lookups)
 
-class Jpeg:
-    def read_segments(content: bytes):
-        segments = []
-        segment = []
-        flag = False
-        for byte in content:
-            # split
-            if byte == 0xFF:
-                flag = True
+    def scan_blocks(self, components: list):
+        'Yield the (component, unit row) blocks of every MCU of a scan, in stream order'
+        mcu_cols, mcu_rows, horizontal_max, vertical_max = self.get_mcu_layout()
+        if len(components) == 1:
+            # 单分量扫描不按MCU交错：按该分量自身的块网格逐行扫描，不包含MCU补齐出来的块
+            index = components[0]
+            horizontal, vertical = self.get_vector_factor(index)
+            cols = ceil(ceil(self.width * horizontal / horizontal_max) / 8)
+            rows = ceil(ceil(self.height * vertical / vertical_max) / 8)
+            for row in range(rows):
+                base = (row // vertical * mcu_cols) * horizontal * vertical + row % vertical * horizontal
+                for col in range(cols):
+                    yield ((index, base + (col // horizontal) * horizontal * vertical + col % horizontal),)
+            return
+        factors = [(index, *self.get_vector_factor(index)) for index in components]
+        for mcu in range(mcu_cols * mcu_rows):
+            yield tuple((index, mcu * horizontal * vertical + block)
+                        for index, horizontal, vertical in factors for block in range(horizontal * vertical))
+
+    def decode_scan(self, components: list, dc_tables: list, ac_tables: list, start: int, end: int
+                    , high: int, low: int, chunks: list, restart_interval: int = 0):
+        'Decode one progressive scan into the persistent coefficient buffers'
+        # components    本次扫描包含的分量下标；dc_tables / ac_tables 与之一一对应
+        views = [memoryview(unit.reshape(-1)) for unit in self.units]
+        blocks = self.scan_blocks(components)
+        interval = restart_interval or len(self.units[0]) * 64
+        for chunk in chunks:
+            # 每个RST分段重新开始DC预测和EOB计数
+            reader = BitReader(chunk)
+            dc_base = [0] * len(self.factor)
+            eobrun = 0
+            for _, mcu in zip(range(interval), blocks):
+                for index, row in mcu:
+                    offset = row * 64
+                    if start == 0:
+                        if high == 0:
+                            dc_base[index] = decode_dc_first(reader, dc_tables[components.index(index)]
+                                                             , dc_base[index], views[index], offset, low)
+                        else:
+                            decode_dc_refine(reader, views[index], offset, low)
+                    elif high == 0:
+                        eobrun = decode_ac_first(reader, ac_tables[0], views[index], offset, start, end, low, eobrun)
+                    else:
+                        eobrun = decode_ac_refine(reader, ac_tables[0], views[index], offset, start, end, low, eobrun)
+                if reader.overrun():
+                    # 数据被截断，剩余的块保持之前扫描的结果
+                    break
+
+    def decode_region(self, x: int, y: int, w: int, h: int, block_size: int = 8, upsampling: str = 'fancy'):
+        'Pixels of a w x h window, only the restart intervals and MCUs covering it are decoded'
+        mcu_cols, mcu_rows, horizontal_max, vertical_max = self.get_mcu_layout()
+        width = ceil(self.width * block_size / 8)
+        height = ceil(self.height * block_size / 8)
+        if x < 0 or y < 0 or w <= 0 or h <= 0 or x + w > width or y + h > height:
+            raise ValueError(f'Region Error, ({x}, {y}, {w}, {h}) out of {width} x {height}')
+        mcu_width = block_size * horizontal_max
+        mcu_height = block_size * vertical_max
+        # 三角滤波需要相邻MCU的色度作为上下文，四周各多解码一个MCU
+        margin = 1 if upsampling == 'fancy' and (horizontal_max > 1 or vertical_max > 1) else 0
+        row_start = max(0, y // mcu_height - margin)
+        row_end = min(mcu_rows, ceil((y + h) / mcu_height) + margin)
+        col_start = max(0, x // mcu_width - margin)
+        col_end = min(mcu_cols, ceil((x + w) / mcu_width) + margin)
+        region_rows = row_end - row_start
+        region_cols = col_end - col_start
+        # 窗口内每个MCU在扫描中的序号
+        mcus = (np.arange(row_start, row_end)[:, None] * mcu_cols + np.arange(col_start, col_end)).ravel()
+
+        # 只熵解码与窗口MCU相交的RST分段；没有DRI时只能从头解码到窗口的最后一个MCU
+        interval = self.restart_interval or mcu_cols * mcu_rows
+        intervals = np.unique(mcus // interval)
+        intervals = intervals[intervals < len(self.data)]
+        vector_order = self.get_mcu_order()
+        dc_tables, ac_tables = self.get_huffman_tables()
+        region = []
+        for vector_index in range(len(self.factor)):
+            horizontal, vertical = self.get_vector_factor(vector_index)
+            region.append(np.zeros((len(mcus), horizontal * vertical, 64), np.int16))
+        for index in intervals:
+            first = index * interval
+            count = min(interval, int(mcus[-1]) + 1 - first)
+            units, _, _ = decode_interval(bytes(self.data[index]), vector_order, dc_tables, ac_tables, count)
+            # 分段内属于窗口的MCU，放到窗口中对应的位置；数据不完整时缺少的部分保持为0
+            selected = np.flatnonzero((mcus >= first) & (mcus < first + count))
+            for vector_index, unit in enumerate(units):
+                unit = unit.reshape(-1, region[vector_index].shape[1], 64)
+                offsets = mcus[selected] - first
+                present = offsets < len(unit)
+                region[vector_index][selected[present]] = unit[offsets[present]]
+        get_observer().count('restart_intervals', len(intervals))
+
+        planes = []
+        for vector_index, units in enumerate(region):
+            horizontal, vertical = self.get_vector_factor(vector_index)
+            units = units.reshape(-1, 64)
+            table = self.quantization_table[self.dqt_map[vector_index][1]]
+            samples = idct_blocks(dequantize(units, table, block_size))
+            plane = tile_blocks(samples, region_rows, region_cols, vertical, horizontal)
+            plane = upsample(plane, vertical_max // vertical, horizontal_max // horizontal, upsampling)
+            top = y - row_start * mcu_height
+            left = x - col_start * mcu_width
+            planes.append(plane[top: top + h, left: left + w])
+        return planes_to_pixels(planes)
+
+    def decode_quantization(self, block_size: int = 8):
+        # block_size < 8 时只保留左上角的低频系数（缩放解码）
+        self.block_size = block_size
+        # 按分量对整个系数缓冲区一次性反量化并还原zig-zag，未解码到的数据单元全为0
+        self.coefficients = []
+        for vector_index, units in enumerate(self.units):
+            table = self.quantization_table[self.dqt_map[vector_index][1]]
+            self.coefficients.append(dequantize(units, table, block_size))
+
+    def idct(self):
+        self.samples = [idct_blocks(coefficients) for coefficients in self.coefficients]
+
+class RestartIndex:
+    'Byte offsets and first MCU of every restart interval of a baseline scan, saved as a sidecar file'
+    # offsets   (N, 2) 每个RST分段熵编码数据的 [开始, 结束) 字节偏移，不含RSTn标记
+    # 第k个分段从第 k * restart_interval 个MCU开始
+    # file_size / header_crc 用于判断sidecar是否还对应原文件
+    MAGIC = b'RSTX'
+    HEADER = '>4sBQIIIQ'
+
+    def __init__(self, restart_interval: int, mcu_count: int, offsets, file_size: int, header_crc: int) -> None:
+        self.restart_interval = restart_interval
+        self.mcu_count = mcu_count
+        self.offsets = np.asarray(offsets, dtype=np.int64).reshape(-1, 2)
+        self.file_size = file_size
+        self.header_crc = header_crc
+
+    def chunks(self, buffer: memoryview) -> list:
+        return [ScanChunk(buffer, int(start), int(end)) for start, end in self.offsets]
+
+    def matches(self, file_size: int, header_crc: int, restart_interval: int) -> bool:
+        return (self.file_size, self.header_crc, self.restart_interval) == (file_size, header_crc, restart_interval)
+
+    def save(self, path: str):
+        with open(path, 'wb') as f:
+            f.write(pack(RestartIndex.HEADER, RestartIndex.MAGIC, 1, self.file_size, self.header_crc
+                         , self.restart_interval, self.mcu_count, len(self.offsets)))
+            f.write(self.offsets.astype('>i8').tobytes())
+
+    def load(path: str):
+        with open(path, 'rb') as f:
+            data = f.read()
+        size = calcsize(RestartIndex.HEADER)
+        if len(data) < size:
+            raise ValueError(f'Restart Index Error, {path} is not a valid index')
+        magic, version, file_size, header_crc, restart_interval, mcu_count, count \
+            = unpack_from(RestartIndex.HEADER, data)
+        if magic != RestartIndex.MAGIC or version != 1 or len(data) != size + count * 16:
+            raise ValueError(f'Restart Index Error, {path} is not a valid index')
+        offsets = np.frombuffer(data, dtype='>i8', offset=size).astype(np.int64)
+        return RestartIndex(restart_interval, mcu_count, offsets, file_size, header_crc)
+
+def sidecar_path(path: str) -> str:
+    return path + '.rstidx'
+
+class SegmentIndex:
+    'Marker index over the original file buffer'
+    # entries   (marker, offset, length)
+    #       offset  marker字节（0xFF之后的那个字节）在文件中的位置
+    #       length  段声明的数据长度，包含自身；SOI/EOI没有长度字段，记为0
+    # scans     SOS在entries中的下标 -> 按RSTn切分的熵编码数据（ScanChunk）
+    # split_scans 为False时不逐字节查找RSTn，扫描数据整体作为一个ScanChunk（直到最后一个EOI），
+    #             配合RestartIndex使用
+    def __init__(self, content: bytes, split_scans: bool = True) -> None:
+        self.buffer = memoryview(content)
+        self.entries = []
+        self.scans = {}
+        get_observer().count('bytes_scanned', len(content))
+        pos = content.find(b'\xff')
+        while pos != -1 and pos + 1 < len(content):
+            marker = content[pos + 1]
+            if marker == 0xFF:
+                # 填充字节
+                pos += 1
                 continue
-            # parse
-            if flag is False:
-                segment.append(byte)
-            else:
-                flag = False
-                if byte == 0x00:
-                    segment.append(0xFF)
-                elif byte == 0xD8:
-                    segment = [0xD8]
-                elif byte == 0xD9:
-                    segments.append(segment)
-                    segments.append([0xD9])
+            if marker == 0x00 or 0xD0 <= marker <= 0xD7:
+                # 扫描数据之外不应出现，跳过
+                pos = content.find(b'\xff', pos + 2)
+                continue
+            if marker == 0xD8 or marker == 0xD9:
+                self.entries.append((marker, pos + 1, 0))
+                if marker == 0xD9:
                     break
-                else:
-                    segments.append(segment)
-                    segment = [byte]
-        return segments
+                pos += 2
+            else:
+                length = unpack_from('>H', content, pos + 2)[0]
+                self.entries.append((marker, pos + 1, length))
+                pos += 2 + length
+                if marker == 0xDA:
+                    if split_scans:
+                        self.scans[len(self.entries) - 1], pos = self.split_scan(content, pos)
+                    else:
+                        end = content.rfind(b'\xff\xd9')
+                        end = end if end >= pos else len(content)
+                        self.scans[len(self.entries) - 1] = [ScanChunk(self.buffer, pos, end)]
+                        pos = end
+            if pos < len(content) and content[pos] != 0xFF:
+                pos = content.find(b'\xff', pos)
+
+    def split_scan(self, content: bytes, start: int):
+        chunks = []
+        pos = start
+        while True:
+            pos = content.find(b'\xff', pos)
+            if pos == -1 or pos + 1 >= len(content):
+                chunks.append(ScanChunk(self.buffer, start, len(content)))
+                return chunks, len(content)
+            marker = content[pos + 1]
+            if marker == 0x00:
+                pos += 2
+                continue
+            if marker == 0xFF:
+                pos += 1
+                continue
+            # marker前的0xFF都是填充字节
+            end = pos
+            while end > start and content[end - 1] == 0xFF:
+                end -= 1
+            chunks.append(ScanChunk(self.buffer, start, end))
+            if not 0xD0 <= marker <= 0xD7:
+                return chunks, pos
+            start = pos + 2
+            pos = start
+
+    def segment(self, index: int) -> memoryview:
+        _, offset, length = self.entries[index]
+        return self.buffer[offset: offset + 1 + length]
+
+    def print(self):
+        print(f'===== Segment Index =====')
+        print('(Marker, Offset, Length)')
+        for marker, offset, length in self.entries:
+            print((hex(marker), offset, length))
+
+class Jpeg:
+    def read_segments(content: bytes):
+        return SegmentIndex(content)
 
-    def _parse_segments(self, segments: list):
+    def _start_segments(self):
         self.dht_list: list[DHT] = []
         self.dqt_list: list[DQT] = []
-        SOI(segments[0])
-        EOI(segments[-1])
-        for seg in segments[1: -1]:
-            if seg[0] == 0xE0:
-                self.app0 = APP0(seg)
-            elif seg[0] == 0xC0:
-                self.sof0 = SOF0(seg)
-            elif seg[0] == 0xC4:
-                # 哈夫曼表可以重复出现（一般出现4次）
-                self.dht_list.append(DHT(seg))
-            elif seg[0] == 0xDB:
-                self.dqt_list.append(DQT(seg))
-            elif seg[0] == 0xDD:
-                self.dri = DRI(seg)
-            elif seg[0] == 0xFE:
-                self.com = COM(seg)
-            elif seg[0] == 0xDA:
-                self.sos = SOS(seg)
-                self.frame.append(seg[1 + self.sos.length:])
-            elif seg[0] == 0xD0 \
-                    or seg[0] == 0xD1 \
-                    or seg[0] == 0xD2 \
-                    or seg[0] == 0xD3 \
-                    or seg[0] == 0xD4 \
-                    or seg[0] == 0xD5 \
-                    or seg[0] == 0xD6 \
-                    or seg[0] == 0xD7:
-                self.frame.append(seg[1:])
-            else:
-                print('===== Unknown Segment:', hex(seg[0]), '=====')
+        self.progressive = False
+        # 渐进式的每次扫描：(SOS, 当时生效的哈夫曼表 {(类型, ID): HuffmanTable}, RST间隔, 熵编码数据)
+        # 扫描之间可以重新定义哈夫曼表和RST间隔，所以按出现顺序记录
+        self.scan_list = []
+        self.huffman_tables = {}
+        self.restart_interval = 0
+
+    def _parse_segment(self, seg: memoryview):
+        'One marker segment starting at the marker byte, SOS only parses the scan header'
+        if seg[0] == 0xE0:
+            self.app0 = APP0(seg)
+        elif seg[0] == 0xC0:
+            self.sof0 = SOF0(seg)
+        elif seg[0] == 0xC2:
+            # SOF2与SOF0格式相同
+            self.sof0 = SOF0(seg)
+            self.progressive = True
+        elif seg[0] == 0xC4:
+            # 哈夫曼表可以重复出现（一般出现4次）
+            dht = compiled_dht(seg)
+            self.dht_list.append(dht)
+            self.huffman_tables[(dht.table_type.value, dht.id)] = dht.decoder
+        elif seg[0] == 0xDB:
+            self.dqt_list.append(compiled_dqt(seg))
+        elif seg[0] == 0xDD:
+            self.dri = DRI(seg)
+            self.restart_interval = self.dri.interval
+        elif seg[0] == 0xFE:
+            self.com = COM(seg)
+        elif seg[0] == 0xDA:
+            self.sos = SOS(seg, self.progressive)
+        else:
+            get_observer().event('unknown_segment', marker=hex(seg[0]), length=len(seg))
+
+    def _parse_segments(self, segments: SegmentIndex):
+        self._start_segments()
+        if not segments.entries:
+            # 没有任何marker，不是JPEG
+            raise ValueError("SOI Read Error")
+        SOI(segments.segment(0))
+        EOI(segments.segment(-1))
+        for index in range(1, len(segments.entries) - 1):
+            seg = segments.segment(index)
+            self._parse_segment(seg)
+            if seg[0] == 0xDA:
+                # 熵编码数据已按RSTn切分
+                if self.progressive:
+                    self.scan_list.append((self.sos, dict(self.huffman_tables), self.restart_interval
+                                           , segments.scans[index]))
+                    continue
+                for chunk in segments.scans[index]:
+                    self.frame.append(chunk)
 
     def build_quantization_table(self):
         dqt_dist = {}
         for dqt in self.dqt_list:
-            dqt_dist[dqt.id] = dqt.table
-            self.frame.add_quantization_table(dqt.table)
+            dqt_dist[dqt.id] = dqt.values
+            self.frame.add_quantization_table(dqt.decoder)
         return dqt_dist
 
-    def __init__(self, path: str) -> None:
-        self.frame = Frame()
-        with open(path, 'rb') as f:
-            content = f.read()
-        segments = Jpeg.read_segments(content)
-        self._parse_segments(segments)
+    def _build_frame(self):
+        'Configure the frame from the parsed SOF0/SOS/DRI and load its Huffman and quantization tables'
         self.frame.config(self.sof0.width, self.sof0.height
                           , self.sof0.factor
                           , self.sof0.dqt_map
-                          , self.sos.dht_map)
+                          , self.sos.dht_map
+                          , self.dri.interval if hasattr(self, 'dri') else 0)
         for dht in self.dht_list:
             if dht.table_type is DHT.TableType.DC:
-                self.frame.add_huffman_table_direct(dht.table)
+                self.frame.add_huffman_table_direct(dht.decoder)
             else:
-                self.frame.add_huffman_table_alternate(dht.table)
-        dqt_dist = self.build_quantization_table()
+                self.frame.add_huffman_table_alternate(dht.decoder)
+        return self.build_quantization_table()
+
+    def __init__(self, path: str, workers: int = 1, executor: str = 'process', scale: float = 1
+                 , upsampling: str = 'fancy', stream: bool = False, preview=None, index: bool = False) -> None:
+        # workers > 1 时按RST分段并行做哈夫曼解码，executor为'process'或'thread'
+        # scale 为 1、1/2、1/4 或 1/8，在DCT域直接缩小输出
+        # upsampling 为色度上采样方式：'nearest'（复制）或'fancy'（三角滤波）
+        # stream 为True时只解析文件头（文件以mmap方式映射），像素通过rows()逐MCU行解码，渐进式通过previews()
+        # preview 渐进式JPEG每次扫描后的回调 preview(pixels, scan_index, fraction)，fraction为已读取的文件比例
+        # index 为True时使用（或生成）path.rstidx中的RST偏移索引，打开时不再逐字节查找RSTn，供decode_region()使用
+        if scale not in (1, 1 / 2, 1 / 4, 1 / 8):
+            raise ValueError(f'Scale Error, Expect 1, 1/2, 1/4 or 1/8, Read({scale})')
+        self.scale = scale
+        self.upsampling = upsampling
+        self.frame = Frame()
+        observer = get_observer()
+        with observer.span('read_file', path=path), open(path, 'rb') as f:
+            if stream:
+                content = mmap(f.fileno(), 0, access=ACCESS_READ)
+            else:
+                content = f.read()
+        self.restart_index = None
+        sidecar = None
+        if index and os.path.exists(sidecar_path(path)):
+            try:
+                sidecar = RestartIndex.load(sidecar_path(path))
+            except (OSError, ValueError) as e:
+                # 读不了或损坏的sidecar当作没有，完整扫描文件
+                observer.event('warning', message=f'Restart Index Error: {e}')
+        with observer.span('read_segments'):
+            segments = SegmentIndex(content, split_scans=sidecar is None)
+        with observer.span('parse_segments'):
+            self._parse_segments(segments)
+        if sidecar is not None:
+            restart_interval = self.dri.interval if hasattr(self, 'dri') else 0
+            if not self.progressive and sidecar.matches(len(content), Jpeg.header_crc(segments), restart_interval):
+                self.frame.data = sidecar.chunks(segments.buffer)
+                self.restart_index = sidecar
+            else:
+                # 索引已过期，重新完整解析
+                self.frame = Frame()
+                segments = SegmentIndex(content)
+                self._parse_segments(segments)
+        with observer.span('build_frame'):
+            self._build_frame()
+        if index and self.restart_index is None and not self.progressive:
+            self.restart_index = self.build_restart_index(segments)
+            try:
+                self.restart_index.save(sidecar_path(path))
+            except OSError as e:
+                # 原文件所在目录只读时不写sidecar，索引只在本次使用，下次仍完整扫描
+                observer.event('warning', message=f'Restart Index Error: {e}')
+        if stream:
+            return
         # Decode
         # huffman and diff
-        self.frame.decode_huffman()
+        with observer.span('decode_huffman', workers=workers):
+            if self.progressive:
+                for scan_index, fraction in self.decode_scans():
+                    if preview is not None:
+                        preview(self.reconstruct(), scan_index, fraction)
+            else:
+                self.frame.decode_huffman(workers, executor)
         #  zig-zag
-        self.frame.decode_quantization()
+        with observer.span('decode_quantization'):
+            self.frame.decode_quantization(int(8 * scale))
         # IDCT
-        zigzag = zigzag_matrix(8)
+        with observer.span('idct'):
+            self.frame.idct()
         # YCrCb to RGB
+        with observer.span('color_convert'):
+            self.pixels = Raster.from_array(self.frame.color_convert(upsampling))
+
+    def header_crc(segments: SegmentIndex) -> int:
+        'CRC32 of everything before the first scan data, identifies the file for the restart index sidecar'
+        _, offset, length = segments.entries[min(segments.scans)]
+        return crc32(segments.buffer[: offset + 1 + length])
+
+    def build_restart_index(self, segments: SegmentIndex) -> RestartIndex:
+        mcu_cols, mcu_rows, _, _ = self.frame.get_mcu_layout()
+        offsets = [(chunk.start, chunk.end) for chunk in self.frame.data]
+        return RestartIndex(self.frame.restart_interval, mcu_cols * mcu_rows, offsets, len(segments.buffer)
+                            , Jpeg.header_crc(segments))
+
+    def decode_region(self, x: int, y: int, w: int, h: int):
+        'Raster of the w x h window at (x, y) in output (scaled) coordinates, decoding only the MCUs covering it'
+        if self.progressive:
+            raise ValueError('Region Error, Progressive JPEG cannot be decoded by region')
+        with get_observer().span('decode_region', x=x, y=y, w=w, h=h):
+            return Raster.from_array(self.frame.decode_region(x, y, w, h, int(8 * self.scale), self.upsampling))
+
+    def rows(self):
+        'Yield pixel strips of one MCU row each, from top to bottom'
+        if self.progressive:
+            raise ValueError('Stream Error, Progressive JPEG has no row order, use previews()')
+        return self.frame.decode_rows(int(8 * self.scale), self.upsampling)
+
+    def decode_scans(self):
+        'Progressive: decode the scans in order into one coefficient buffer, yield (scan index, fraction read)'
+        frame = self.frame
+        mcu_cols, mcu_rows, _, _ = frame.get_mcu_layout()
+        frame.units = frame.allocate_units(mcu_cols * mcu_rows)
+        frame.unit_count = [len(units) for units in frame.units]
+        size = len(self.scan_list[-1][3][-1].buffer) if self.scan_list else 1
+        for scan_index, (sos, tables, restart_interval, chunks) in enumerate(self.scan_list):
+            self.decode_scan(sos, tables, restart_interval, chunks)
+            yield scan_index, chunks[-1].end / size
+
+    def decode_scan(self, sos: SOS, tables: dict, restart_interval: int, chunks: list):
+        'Progressive: decode one scan, chunks are its restart intervals as anything bytes() un-stuffs'
+        vector_ids = [vector_id for vector_id, _, _ in self.frame.factor]
+        components = [vector_ids.index(vector_id) for vector_id, _, _ in sos.dht_map]
+        dc_tables = [tables.get((0, dc_id)) for _, dc_id, _ in sos.dht_map]
+        ac_tables = [tables.get((1, ac_id)) for _, _, ac_id in sos.dht_map]
+        self.frame.decode_scan(components, dc_tables, ac_tables
+                               , sos.thumbnail_spectrum_start, sos.thumbnail_spectrum_end
+                               , sos.approximation_high, sos.approximation_low, chunks, restart_interval)
+
+    def reconstruct(self):
+        'Raster from the coefficients decoded so far'
+        self.frame.decode_quantization(int(8 * self.scale))
+        self.frame.idct()
+        return Raster.from_array(self.frame.color_convert(self.upsampling))
+
+    def previews(self):
+        'Progressive, stream mode: decode scan by scan, yield (pixels, scan index, fraction read) after each'
+        for scan_index, fraction in self.decode_scans():
+            yield self.reconstruct(), scan_index, fraction
+
+class JpegInfo:
+    'Header-only record returned by probe()'
+    def __init__(self) -> None:
+        self.app0 = None
+        self.appn = []          # (marker, payload)，Exif/ICC/Adobe等原始数据
+        self.comments = []
+        self.sof0 = None
+        self.frame_type = None  # SOF marker, 0xC0 Baseline / 0xC1 Extended / 0xC2 Progressive
+        self.dqt_list: list[DQT] = []
+        self.dht_list: list[DHT] = []
+        self.dri = None
+        self.sos = None
+        self.scan_offset = None # 第一个扫描的熵编码数据在文件中的位置
+
+    @property
+    def width(self):
+        return self.sof0.width
+
+    @property
+    def height(self):
+        return self.sof0.height
+
+    @property
+    def factor(self):
+        return self.sof0.factor
+
+    @property
+    def progressive(self):
+        return self.frame_type == 0xC2
+
+    def quality(self):
+        'Estimated libjpeg quality factor (1~100) of the luminance quantization table'
+        if not self.dqt_list:
+            return None
+        table_id = self.sof0.dqt_map[0][1] if self.sof0 else self.dqt_list[0].id
+        tables = {dqt.id: dqt for dqt in self.dqt_list}
+        dqt = tables.get(table_id, self.dqt_list[0])
+        table = dqt.values.astype(np.float64)
+        # libjpeg: table = (base * scale + 50) / 100
+        #       quality < 50: scale = 5000 / quality
+        #       quality >= 50: scale = 200 - 2 * quality
+        # 表项按zig-zag顺序存放，被截断到1或255的表项不参与估计
+        base = np.empty(64)
+        base[ZIGZAG] = STD_LUMINANCE_QUANTIZATION
+        mask = (table > 1) & (table < 255)
+        if not mask.any():
+            return 100 if table.max() <= 1 else 1
+        scale = 100 * table[mask].sum() / base[mask].sum()
+        if scale <= 100:
+            quality = (200 - scale) / 2
+        else:
+            quality = 5000 / scale
+        return int(min(100, max(1, round(quality))))
+
+    def print(self):
+        print(f'===== Jpeg Info =====')
+        print('Frame Type:', hex(self.frame_type))
+        print('Image Width x Heigth:', self.width, self.height)
+        print('Table ID: (Vector ID, Horizontal Factor, Vertical Factor)')
+        for vector in self.factor:
+            print(vector)
+        print('Quality:', self.quality())
+        print('Restart Interval:', self.dri.interval if self.dri else 0)
+        print('APPn:', [hex(marker) for marker, _ in self.appn])
+
+def probe(path_or_file):
+    'Read the JPEG headers up to the first SOS using the declared segment lengths, without touching scan data'
+    if hasattr(path_or_file, 'read'):
+        return probe_file(path_or_file)
+    with open(path_or_file, 'rb') as f:
+        return probe_file(f)
+
+def probe_file(f: BufferedReader):
+    info = JpegInfo()
+    SOI(f.read(2)[1:])
+    while True:
+        byte = f.read(1)
+        if byte == b'':
+            raise ValueError('Probe Error, SOS Not Found')
+        if byte != b'\xff':
+            continue
+        marker = f.read(1)
+        while marker == b'\xff':
+            # 填充字节
+            marker = f.read(1)
+        if marker == b'' or marker == b'\x00' or 0xD0 <= marker[0] <= 0xD9:
+            continue
+        length = f.read(2)
+        segment = marker + length + f.read(unpack_from('>H', length)[0] - 2)
+        marker = marker[0]
+        if marker == 0xE0 and segment[3:8] == b'JFIF\x00':
+            info.app0 = APP0(segment)
+        elif 0xE0 <= marker <= 0xEF:
+            info.appn.append((marker, segment[3:]))
+        elif 0xC0 <= marker <= 0xC2:
+            info.frame_type = marker
+            info.sof0 = SOF0(segment)
+        elif marker == 0xC4:
+            info.dht_list.append(DHT(segment))
+        elif marker == 0xDB:
+            info.dqt_list.append(DQT(segment))
+        elif marker == 0xDD:
+            info.dri = DRI(segment)
+        elif marker == 0xFE:
+            info.comments.append(segment[3:])
+        elif marker == 0xDA:
+            info.sos = SOS(segment, info.frame_type == 0xC2)
+            info.scan_offset = f.tell()
+            return info
 
 def zigzag_matrix(width):
     matrix = [0] * (width * width)
@@ -614,6 +1465,106 @@ def zigzag_matrix(width):
                 matrix[row * width + col] = pre + width - row
     return matrix
 
+def idct_matrix(width):
+    # C[u][x] = c(u) * cos((2x + 1) * u * pi / 2N)，IDCT: f = C^T · F · C
+    matrix = np.zeros((width, width))
+    for u in range(width):
+        scale = np.sqrt(1 / width) if u == 0 else np.sqrt(2 / width)
+        for x in range(width):
+            matrix[u, x] = scale * np.cos((2 * x + 1) * u * np.pi / (2 * width))
+    return matrix
+
+ZIGZAG = np.array(zigzag_matrix(8))
+
+# Annex K 推荐的量化表（自然顺序）
+STD_LUMINANCE_QUANTIZATION = np.array([
+    16, 11, 10, 16, 24, 40, 51, 61,
+    12, 12, 14, 19, 26, 58, 60, 55,
+    14, 13, 16, 24, 40, 57, 69, 56,
+    14, 17, 22, 29, 51, 87, 80, 62,
+    18, 22, 37, 56, 68, 109, 103, 77,
+    24, 35, 55, 64, 81, 104, 113, 92,
+    49, 64, 78, 87, 103, 121, 120, 101,
+    72, 92, 95, 98, 112, 100, 103, 99])
+STD_CHROMINANCE_QUANTIZATION = np.array([
+    17, 18, 24, 47, 99, 99, 99, 99,
+    18, 21, 26, 66, 99, 99, 99, 99,
+    24, 26, 56, 99, 99, 99, 99, 99,
+    47, 66, 99, 99, 99, 99, 99, 99,
+    99, 99, 99, 99, 99, 99, 99, 99,
+    99, 99, 99, 99, 99, 99, 99, 99,
+    99, 99, 99, 99, 99, 99, 99, 99,
+    99, 99, 99, 99, 99, 99, 99, 99])
+# 缩放解码：1/2、1/4、1/8分别只用左上角4x4、2x2、1x1的系数做IDCT
+IDCT = {size: idct_matrix(size).astype(np.float32) for size in (1, 2, 4, 8)}
+# 左上角 size x size 系数（自然顺序）在zig-zag序列中的下标
+ZIGZAG_CORNER = {size: ZIGZAG.reshape(8, 8)[:size, :size].ravel() for size in (1, 2, 4, 8)}
+
+def dequantize(units: np.ndarray, table: QuantizationTable, size: int = 8) -> np.ndarray:
+    'zig-zag ordered (N, 64) coefficients -> dequantized (N, size, size) low-frequency corner in natural order'
+    coefficients = units[:, ZIGZAG_CORNER[size]].astype(np.float32) * table.scaled[size]
+    return coefficients.reshape(-1, size, size)
+
+def idct_blocks(coefficients: np.ndarray) -> np.ndarray:
+    'Separable IDCT over (N, size, size) blocks, level shifted and clipped to uint8'
+    size = coefficients.shape[-1]
+    # 低频系数按 size / 8 缩放，保证DC对应的平均亮度不变
+    samples = IDCT[size].T @ (coefficients * (size / 8)) @ IDCT[size]
+    return np.clip(np.rint(samples + 128), 0, 255).astype(np.uint8)
+
+def tile_blocks(blocks: np.ndarray, mcu_rows: int, mcu_cols: int, vertical: int, horizontal: int) -> np.ndarray:
+    'MCU ordered (N, size, size) blocks of one component -> 2D sample plane'
+    size = blocks.shape[-1]
+    count = mcu_rows * mcu_cols * vertical * horizontal
+    if len(blocks) < count:
+        # 数据不完整时用灰色补齐
+        blocks = np.concatenate([blocks, np.full((count - len(blocks), size, size), 128, np.uint8)])
+    blocks = blocks[:count].reshape(mcu_rows, mcu_cols, vertical, horizontal, size, size)
+    return blocks.transpose(0, 2, 4, 1, 3, 5).reshape(mcu_rows * vertical * size, mcu_cols * horizontal * size)
+
+def upsample_axis(plane: np.ndarray, factor: int, axis: int) -> np.ndarray:
+    # 三角滤波：输出采样点中心映射回输入坐标后线性插值，边缘复制
+    length = plane.shape[axis]
+    position = np.clip((np.arange(length * factor) + 0.5) / factor - 0.5, 0, length - 1)
+    low = np.floor(position).astype(np.intp)
+    high = np.minimum(low + 1, length - 1)
+    weight = (position - low).astype(np.float32)
+    weight = weight.reshape((-1, 1) if axis == 0 else (1, -1))
+    return np.take(plane, low, axis) * (1 - weight) + np.take(plane, high, axis) * weight
+
+def upsample(plane: np.ndarray, vertical: int, horizontal: int, method: str = 'fancy') -> np.ndarray:
+    if vertical == 1 and horizontal == 1:
+        return plane
+    if method == 'nearest':
+        return plane.repeat(vertical, axis=0).repeat(horizontal, axis=1)
+    elif method == 'fancy':
+        plane = plane.astype(np.float32)
+        if vertical > 1:
+            plane = upsample_axis(plane, vertical, 0)
+        if horizontal > 1:
+            plane = upsample_axis(plane, horizontal, 1)
+        return plane
+    else:
+        raise ValueError(f'Upsample Error, Unknown Method: {method}')
+
+def ycbcr_to_rgb(y: np.ndarray, cb: np.ndarray, cr: np.ndarray) -> np.ndarray:
+    'JFIF YCbCr planes -> (H, W, 3) uint8 RGB'
+    y = y.astype(np.float32)
+    cb = cb.astype(np.float32) - 128
+    cr = cr.astype(np.float32) - 128
+    rgb = np.stack((y + 1.402 * cr
+                    , y - 0.344136 * cb - 0.714136 * cr
+                    , y + 1.772 * cb), axis=-1)
+    return np.clip(np.rint(rgb), 0, 255).astype(np.uint8)
+
+def planes_to_pixels(planes: list) -> np.ndarray:
+    if len(planes) == 1:
+        return np.clip(np.rint(planes[0]), 0, 255).astype(np.uint8)
+    elif len(planes) == 3:
+        return ycbcr_to_rgb(*planes)
+    else:
+        raise ValueError(f'Color Convert Error, Unknown Vector Count: {len(planes)}')
+
 if __name__ == '__main__':
     width = 4
     matrix = zigzag_matrix(width)
@@ -1,63 +1,514 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from struct import pack
 from io import BufferedWriter
+from itertools import repeat
+
+import numpy as np
+
+from instrument import get_observer
+from jpeg_decoder import STD_CHROMINANCE_QUANTIZATION, STD_LUMINANCE_QUANTIZATION, idct_matrix, zigzag_matrix
+
+# Annex K 推荐的哈夫曼表：不同位数的码字数量（16个）和对应的权值
+STD_DC_LUMINANCE = ([0, 1, 5, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0, 0, 0]
+                    , list(range(12)))
+STD_DC_CHROMINANCE = ([0, 3, 1, 1, 1, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0]
+                      , list(range(12)))
+STD_AC_LUMINANCE = ([0, 2, 1, 3, 3, 2, 4, 3, 5, 5, 4, 4, 0, 0, 1, 0x7D]
+                    , [0x01, 0x02, 0x03, 0x00, 0x04, 0x11, 0x05, 0x12, 0x21, 0x31, 0x41, 0x06, 0x13, 0x51, 0x61, 0x07,
+                       0x22, 0x71, 0x14, 0x32, 0x81, 0x91, 0xA1, 0x08, 0x23, 0x42, 0xB1, 0xC1, 0x15, 0x52, 0xD1, 0xF0,
+                       0x24, 0x33, 0x62, 0x72, 0x82, 0x09, 0x0A, 0x16, 0x17, 0x18, 0x19, 0x1A, 0x25, 0x26, 0x27, 0x28,
+                       0x29, 0x2A, 0x34, 0x35, 0x36, 0x37, 0x38, 0x39, 0x3A, 0x43, 0x44, 0x45, 0x46, 0x47, 0x48, 0x49,
+                       0x4A, 0x53, 0x54, 0x55, 0x56, 0x57, 0x58, 0x59, 0x5A, 0x63, 0x64, 0x65, 0x66, 0x67, 0x68, 0x69,
+                       0x6A, 0x73, 0x74, 0x75, 0x76, 0x77, 0x78, 0x79, 0x7A, 0x83, 0x84, 0x85, 0x86, 0x87, 0x88, 0x89,
+                       0x8A, 0x92, 0x93, 0x94, 0x95, 0x96, 0x97, 0x98, 0x99, 0x9A, 0xA2, 0xA3, 0xA4, 0xA5, 0xA6, 0xA7,
+                       0xA8, 0xA9, 0xAA, 0xB2, 0xB3, 0xB4, 0xB5, 0xB6, 0xB7, 0xB8, 0xB9, 0xBA, 0xC2, 0xC3, 0xC4, 0xC5,
+                       0xC6, 0xC7, 0xC8, 0xC9, 0xCA, 0xD2, 0xD3, 0xD4, 0xD5, 0xD6, 0xD7, 0xD8, 0xD9, 0xDA, 0xE1, 0xE2,
+                       0xE3, 0xE4, 0xE5, 0xE6, 0xE7, 0xE8, 0xE9, 0xEA, 0xF1, 0xF2, 0xF3, 0xF4, 0xF5, 0xF6, 0xF7, 0xF8,
+                       0xF9, 0xFA])
+STD_AC_CHROMINANCE = ([0, 2, 1, 2, 4, 4, 3, 4, 7, 5, 4, 4, 0, 1, 2, 0x77]
+                      , [0x00, 0x01, 0x02, 0x03, 0x11, 0x04, 0x05, 0x21, 0x31, 0x06, 0x12, 0x41, 0x51, 0x07, 0x61, 0x71,
+                         0x13, 0x22, 0x32, 0x81, 0x08, 0x14, 0x42, 0x91, 0xA1, 0xB1, 0xC1, 0x09, 0x23, 0x33, 0x52, 0xF0,
+                         0x15, 0x62, 0x72, 0xD1, 0x0A, 0x16, 0x24, 0x34, 0xE1, 0x25, 0xF1, 0x17, 0x18, 0x19, 0x1A, 0x26,
+                         0x27, 0x28, 0x29, 0x2A, 0x35, 0x36, 0x37, 0x38, 0x39, 0x3A, 0x43, 0x44, 0x45, 0x46, 0x47, 0x48,
+                         0x49, 0x4A, 0x53, 0x54, 0x55, 0x56, 0x57, 0x58, 0x59, 0x5A, 0x63, 0x64, 0x65, 0x66, 0x67, 0x68,
+                         0x69, 0x6A, 0x73, 0x74, 0x75, 0x76, 0x77, 0x78, 0x79, 0x7A, 0x82, 0x83, 0x84, 0x85, 0x86, 0x87,
+                         0x88, 0x89, 0x8A, 0x92, 0x93, 0x94, 0x95, 0x96, 0x97, 0x98, 0x99, 0x9A, 0xA2, 0xA3, 0xA4, 0xA5,
+                         0xA6, 0xA7, 0xA8, 0xA9, 0xAA, 0xB2, 0xB3, 0xB4, 0xB5, 0xB6, 0xB7, 0xB8, 0xB9, 0xBA, 0xC2, 0xC3,
+                         0xC4, 0xC5, 0xC6, 0xC7, 0xC8, 0xC9, 0xCA, 0xD2, 0xD3, 0xD4, 0xD5, 0xD6, 0xD7, 0xD8, 0xD9, 0xDA,
+                         0xE2, 0xE3, 0xE4, 0xE5, 0xE6, 0xE7, 0xE8, 0xE9, 0xEA, 0xF2, 0xF3, 0xF4, 0xF5, 0xF6, 0xF7, 0xF8,
+                         0xF9, 0xFA])
+
+# 采样格式 -> 亮度分量的 (水平采样, 垂直采样)，色度分量固定为 (1, 1)
+SUBSAMPLING = {
+    '4:4:4': (1, 1),
+    '4:2:2': (2, 1),
+    '4:2:0': (2, 2),
+}
+
+ZIGZAG = np.array(zigzag_matrix(8))
+# 自然顺序 -> zig-zag 顺序的下标
+UNZIGZAG = np.argsort(ZIGZAG)
+# 二维FDCT写成一个 64x64 矩阵：F = C · f · C^T  <=>  vec(F) = (C ⊗ C) · vec(f)
+FDCT = np.kron(idct_matrix(8), idct_matrix(8))
+RGB_TO_YCBCR = np.array([[0.299, 0.587, 0.114]
+                         , [-0.168736, -0.331264, 0.5]
+                         , [0.5, -0.418688, -0.081312]], np.float32)
 
 def write_soi(f: BufferedWriter):
     f.write(pack(">H", 0xffd8))
 
+def write_eoi(f: BufferedWriter):
+    f.write(pack(">H", 0xffd9))
+
 def write_app0(f: BufferedWriter):
     f.write(pack(">H", 0xffe0))
     f.write(pack(">H", 16))
-    f.write(pack(">L", 'JFIF'))
-    f.write(pack(">B", 0))
+    f.write(b'JFIF\x00')
     f.write(pack(">H", 0x0101)) # 版本号：1.1
-    f.write(pack(">I", 0x0048))   # X方向像素密度
-    f.write(pack(">I", 0x0048))   # Y方向像素密度
+    f.write(pack(">B", 1))      # 像素单位：pixel/inch
+    f.write(pack(">H", 0x0048)) # X方向像素密度
+    f.write(pack(">H", 0x0048)) # Y方向像素密度
     f.write(pack(">H", 0x0000)) # 无缩略图
 
-def write_dqt0(f: BufferedWriter):
-    f.write(pack(">H", 0xffdb))
+def write_dqt(f: BufferedWriter, table_id, table):
+    # table 为自然顺序，写入时转换为 zig-zag 顺序
+    f.write(pack(">HHB", 0xffdb, 67, table_id))
+    f.write(np.asarray(table, np.uint8)[UNZIGZAG].tobytes())
+
+def write_dqt0(f: BufferedWriter, table):
+    write_dqt(f, 0, table)
+
+def write_dqt1(f: BufferedWriter, table):
+    write_dqt(f, 1, table)
+
+def write_sof0(f: BufferedWriter, width, height, factors):
+    # factors: [(分量ID, 水平采样, 垂直采样, 量化表ID), ...]
+    f.write(pack(">HHBHHB", 0xffc0, 8 + 3 * len(factors), 8, height, width, len(factors)))
+    for vector_id, horizontal, vertical, dqt_id in factors:
+        f.write(pack(">BBB", vector_id, (horizontal << 4) | vertical, dqt_id))
 
-def write_dqt1(f: BufferedWriter):
-    f.write(pack(">H", 0xffdb))
+def write_dht(f: BufferedWriter, table_class, table_id, table):
+    counts, values = table
+    f.write(pack(">HHB", 0xffc4, 19 + len(values), (table_class << 4) | table_id))
+    f.write(bytes(counts))
+    f.write(bytes(values))
 
-def write_sof0(f: BufferedWriter):
-    f.write(pack(">H", 0xffc0))
+def write_dht_dc0(f: BufferedWriter, table=STD_DC_LUMINANCE):
+    write_dht(f, 0, 0, table)
 
-def write_dht_dc0(f: BufferedWriter):
-    f.write(pack(">H", 0xffc4))
+def write_dht_ac0(f: BufferedWriter, table=STD_AC_LUMINANCE):
+    write_dht(f, 1, 0, table)
 
-def write_dht_ac0(f: BufferedWriter):
-    f.write(pack(">H", 0xffc4))
+def write_dht_dc1(f: BufferedWriter, table=STD_DC_CHROMINANCE):
+    write_dht(f, 0, 1, table)
 
-def write_dht_dc1(f: BufferedWriter):
-    f.write(pack(">H", 0xffc4))
+def write_dht_ac1(f: BufferedWriter, table=STD_AC_CHROMINANCE):
+    write_dht(f, 1, 1, table)
 
-def write_dht_ac1(f: BufferedWriter):
-    f.write(pack(">H", 0xffc4))
+def write_dri(f: BufferedWriter, restart_interval):
+    # 每 restart_interval 个MCU插入一个RSTn标记
+    f.write(pack(">HHH", 0xffdd, 4, restart_interval))
 
-def write_sos(f: BufferedWriter):
-    f.write(pack(">H", 0xffda))
+def write_sos(f: BufferedWriter, vector_count):
+    # 亮度分量使用0号哈夫曼表，色度分量使用1号哈夫曼表
+    f.write(pack(">HHB", 0xffda, 6 + 2 * vector_count, vector_count))
+    for index in range(vector_count):
+        table_id = 0 if index == 0 else 0x11
+        f.write(pack(">BB", index + 1, table_id))
+    f.write(pack(">BBB", 0x00, 0x3F, 0x00))
 
-def write_header(f: BufferedWriter):
+def write_header(f: BufferedWriter, width, height, quantization_tables, factors, dc_tables=None, ac_tables=None
+                 , restart_interval=0):
+    # dc_tables / ac_tables: [(counts, values), ...]，缺省使用 Annex K 的标准表
+    dc_tables = dc_tables or [STD_DC_LUMINANCE, STD_DC_CHROMINANCE]
+    ac_tables = ac_tables or [STD_AC_LUMINANCE, STD_AC_CHROMINANCE]
     write_soi(f)
     write_app0(f)
-    write_dqt0(f)
-    write_dqt1(f)
-    write_sof0(f)
-    write_dht_dc0(f)
-    write_dht_ac0(f)
-    write_dht_dc1(f)
-    write_dht_ac1(f)
-    write_sos(f)
-
-def write_data(f: BufferedWriter, biWidth, biHeight):
-    pass
-
-def write_file(path: str):
-    with open(path, 'wb') as f:
-        write_header(f)
-        write_data(f)
+    write_dqt0(f, quantization_tables[0])
+    if len(factors) > 1:
+        write_dqt1(f, quantization_tables[1])
+    write_sof0(f, width, height, factors)
+    write_dht_dc0(f, dc_tables[0])
+    write_dht_ac0(f, ac_tables[0])
+    if len(factors) > 1:
+        write_dht_dc1(f, dc_tables[1])
+        write_dht_ac1(f, ac_tables[1])
+    if restart_interval:
+        write_dri(f, restart_interval)
+    write_sos(f, len(factors))
+
+def quality_table(base, quality):
+    'libjpeg quality scaling of a base quantization table'
+    quality = min(100, max(1, int(quality)))
+    scale = 5000 // quality if quality < 50 else 200 - quality * 2
+    return np.clip((np.asarray(base) * scale + 50) // 100, 1, 255)
+
+def huffman_code_table(table):
+    'Canonical (counts, values) -> per-symbol code and code length arrays'
+    counts, values = table
+    codes = np.zeros(256, np.int64)
+    sizes = np.zeros(256, np.int64)
+    code = 0
+    index = 0
+    for length in range(1, 17):
+        for _ in range(counts[length - 1]):
+            codes[values[index]] = code
+            sizes[values[index]] = length
+            code += 1
+            index += 1
+        code <<= 1
+    return codes, sizes
+
+def optimal_huffman_table(frequencies):
+    'Symbol frequencies (256) -> length-limited optimal (counts, values), Annex K.2'
+    frequencies = [int(value) for value in frequencies[:256]] + [1]
+    # 256 号是保留的伪符号，保证不会出现全1的码字
+    sizes = [0] * 257
+    others = [-1] * 257
+    while True:
+        # 取频率最小的两个符号，v1 频率最小，相等时取编号大的
+        v1 = v2 = -1
+        for index, frequency in enumerate(frequencies):
+            if frequency and (v1 < 0 or frequency <= frequencies[v1]):
+                v1 = index
+        for index, frequency in enumerate(frequencies):
+            if frequency and index != v1 and (v2 < 0 or frequency <= frequencies[v2]):
+                v2 = index
+        if v2 < 0:
+            break
+        frequencies[v1] += frequencies[v2]
+        frequencies[v2] = 0
+        sizes[v1] += 1
+        while others[v1] >= 0:
+            v1 = others[v1]
+            sizes[v1] += 1
+        others[v1] = v2
+        sizes[v2] += 1
+        while others[v2] >= 0:
+            v2 = others[v2]
+            sizes[v2] += 1
+    bits = [0] * 33
+    for size in sizes:
+        if size:
+            bits[size] += 1
+    # 码长限制在16位以内
+    for length in range(32, 16, -1):
+        while bits[length]:
+            shorter = length - 2
+            while not bits[shorter]:
+                shorter -= 1
+            bits[length] -= 2
+            bits[length - 1] += 1
+            bits[shorter + 1] += 2
+            bits[shorter] -= 1
+    # 去掉伪符号占用的最长码字
+    length = 16
+    while not bits[length]:
+        length -= 1
+    bits[length] -= 1
+    values = [symbol for size in range(1, 33) for symbol in range(256) if sizes[symbol] == size]
+    return bits[1:17], values
+
+def rgb_to_ycbcr(pixels: np.ndarray, horizontal=1, vertical=1):
+    'float32 RGB -> [Y, Cb, Cr] planes without level shift, Cb / Cr averaged over horizontal x vertical pixels'
+    # 逐个分量做矩阵-向量乘，比一次乘 3x3 矩阵快，结果也是连续的
+    y = pixels @ RGB_TO_YCBCR[0]
+    # 颜色转换是线性的：先对RGB求平均再转换与先转换再求平均相同，色度只在降采样后的像素上计算
+    # 先竖直（整行切片，连续访问）后水平按步长累加，比 reshape 后 mean 快得多，除法并入转换系数
+    for step, axis in ((vertical, 0), (horizontal, 1)):
+        if step > 1:
+            views = [pixels[i::step] if axis == 0 else pixels[:, i::step] for i in range(step)]
+            pixels = views[0] + views[1]
+            for view in views[2:]:
+                pixels += view
+    scale = np.float32(1 / (horizontal * vertical))
+    return [y, pixels @ (RGB_TO_YCBCR[1] * scale), pixels @ (RGB_TO_YCBCR[2] * scale)]
+
+def plane_units(plane: np.ndarray, horizontal, vertical, mcu_rows, mcu_cols):
+    'Sample plane -> (MCU count, H * V, 64) blocks in MCU order'
+    return plane.reshape(mcu_rows, vertical, 8, mcu_cols, horizontal, 8) \
+        .transpose(0, 3, 1, 4, 2, 5).reshape(mcu_rows * mcu_cols, vertical * horizontal, 64)
+
+def dct_matrix(table) -> np.ndarray:
+    'FDCT, quantization and zig-zag reordering folded into one 64x64 float32 matrix, applied as units @ matrix.T'
+    # 二维FDCT乘以 1/量化值，行按zig-zag顺序排列
+    return (FDCT / np.asarray(table, np.float64).reshape(64, 1))[UNZIGZAG].astype(np.float32)
+
+def forward_dct(units: np.ndarray, matrix: np.ndarray, level_shift=0) -> np.ndarray:
+    '''Quantized (N, 64) int16 zig-zag coefficients of blocks as one product with a dct_matrix
+    level_shift is subtracted from every sample, which only moves the DC coefficient'''
+    product = units.reshape(-1, 64) @ matrix.T
+    # 基线JPEG：DC最多11位，AC最多10位；原地截断和取整，省掉中间数组（标量上下限比按列广播快得多）
+    dc = np.clip(product[:, 0] - level_shift * matrix[0].sum(), -2047, 2047)
+    np.clip(product, -1023, 1023, out=product)
+    product[:, 0] = dc
+    return np.rint(product, out=product).astype(np.int16)
+
+# 每次处理的像素数：按MCU行分带，一带的中间数组能留在L2缓存里
+BAND_PIXELS = 1 << 15
+
+def prepare_units(pixels: np.ndarray, quantization_tables, subsampling='4:2:0'):
+    'Pixels -> (quantized units in scan order, component index of each unit, SOF0 factors, MCU count)'
+    if pixels.ndim == 2:
+        factors = [(1, 1, 1, 0)]
+    else:
+        horizontal, vertical = SUBSAMPLING[subsampling]
+        factors = [(1, horizontal, vertical, 0), (2, 1, 1, 1), (3, 1, 1, 1)]
+    horizontal_max = max(factor[1] for factor in factors)
+    vertical_max = max(factor[2] for factor in factors)
+    height, width = pixels.shape[:2]
+    mcu_rows = -(-height // (8 * vertical_max))
+    mcu_cols = -(-width // (8 * horizontal_max))
+    # 边缘复制补齐到整数个MCU，在uint8原图上一次补齐（已对齐时np.pad也会复制，跳过）
+    padding = ((0, mcu_rows * 8 * vertical_max - height), (0, mcu_cols * 8 * horizontal_max - width))
+    if padding[0][1] or padding[1][1]:
+        pixels = np.pad(pixels, padding + ((0, 0),) * (pixels.ndim - 2), mode='edge')
+    matrices = [dct_matrix(table) for table in quantization_tables]
+    counts = [horizontal * vertical for _, horizontal, vertical, _ in factors]
+    # 按MCU交错：Y0 Y1 Y2 Y3 Cb Cr ...，各带直接写进结果中对应的MCU
+    units = np.empty((mcu_rows * mcu_cols, sum(counts), 64), np.int16)
+    band_height = 8 * vertical_max * max(1, BAND_PIXELS // (64 * vertical_max * horizontal_max * mcu_cols))
+    for top in range(0, len(pixels), band_height):
+        band = pixels[top: top + band_height].astype(np.float32)
+        rows = len(band) // (8 * vertical_max)
+        planes = [band] if band.ndim == 2 else rgb_to_ycbcr(band, horizontal_max, vertical_max)
+        first = top // (8 * vertical_max) * mcu_cols
+        column = 0
+        for index, (plane, (_, horizontal, vertical, dqt_id)) in enumerate(zip(planes, factors)):
+            blocks = plane_units(plane, horizontal, vertical, rows, mcu_cols)
+            # 电平偏移只作用于亮度（Cb/Cr的+128与-128抵消）
+            units[first: first + len(blocks), column: column + counts[index]] = \
+                forward_dct(blocks, matrices[dqt_id], 0 if index else 128).reshape(len(blocks), -1, 64)
+            column += counts[index]
+    vectors = np.repeat(np.arange(len(factors)), counts)
+    return units.reshape(-1, 64), np.tile(vectors, mcu_rows * mcu_cols), factors, mcu_rows * mcu_cols
+
+def bit_size(values: np.ndarray) -> np.ndarray:
+    'Number of bits of |value|, 0 for 0'
+    return np.frexp(np.abs(values).astype(np.float64))[1].astype(np.int64)
+
+def extra_bits(values: np.ndarray, sizes: np.ndarray) -> np.ndarray:
+    # 负数取 value - 1 的低 size 位
+    values = values.astype(np.int64)
+    return np.where(values < 0, values + (np.int64(1) << sizes) - 1, values)
+
+def exclusive_cumsum(values: np.ndarray) -> np.ndarray:
+    result = np.zeros(len(values), np.int64)
+    np.cumsum(values[:-1], out=result[1:])
+    return result
+
+# 系数值 -> 位数 / 附加位的查找表，下标为 value + 2047（基线JPEG的系数范围）
+COEFFICIENT_VALUES = np.arange(-2047, 2048)
+BIT_SIZES = bit_size(COEFFICIENT_VALUES).astype(np.int32)
+EXTRA_BITS = extra_bits(COEFFICIENT_VALUES, BIT_SIZES).astype(np.int32)
+
+def huffman_symbols(units: np.ndarray, vectors: np.ndarray):
+    '''Zig-zag units with DC differences -> ((key, extra bits, extra size, stream index) of every DC and nonzero AC
+    coefficient, (key, stream index) of every EOB / ZRL code, total code count, stream index of every unit's DC)
+    key = 256 * slot + symbol，slot 0/1 为DC表0/1，2/3 为AC表0/1；stream index 为编码在码流中的序号'''
+    # DC总要编码，和非零AC一起按码流顺序取出；每块的第一项就是DC
+    present = units != 0
+    present[:, 0] = True
+    counts = np.count_nonzero(present, axis=1)
+    starts = exclusive_cumsum(counts)
+    flat = np.flatnonzero(present)
+    values = units.reshape(-1)[flat] + 2047
+    # 同一块内相邻两项的下标差 - 1 就是中间0的个数
+    run = np.empty(len(flat), np.int32)
+    run[0] = 0
+    np.subtract(flat[1:], flat[:-1], out=run[1:], casting='unsafe')
+    run -= 1
+    run[starts] = 0
+    sizes = BIT_SIZES[values]
+    keys = (run & 15) << 4
+    keys |= sizes
+    keys += np.repeat((vectors.astype(np.int32) + 2) << 8, counts)
+    keys[starts] -= 512
+    # 最后一个系数（第63位）为0时需要EOB
+    eob = ~present[:, 63]
+    marker_keys = [(vectors[eob].astype(np.int32) + 2) << 8]
+    # 连续16个0用ZRL(0xF0)表示，放在对应AC编码之前；EOB放在下一块的DC之前
+    zrl = run >> 4
+    repeat_at = np.flatnonzero(zrl)
+    repeat = zrl[repeat_at]
+    zrl[starts[1:]] += eob[:-1]
+    stream = np.cumsum(zrl, out=zrl)
+    stream += np.arange(len(flat), dtype=np.int32)
+    marker_stream = [stream[starts + counts - 1][eob] + 1]
+    if len(repeat):
+        first = np.repeat(stream[repeat_at] - repeat, repeat)
+        marker_stream.append(first + np.arange(len(first)) - np.repeat(exclusive_cumsum(repeat), repeat))
+        marker_keys.append(np.repeat((keys[repeat_at] >> 8 << 8) | 0xF0, repeat))
+    total = len(flat) + int(eob.sum()) + int(repeat.sum())
+    return (keys, EXTRA_BITS[values], sizes, stream), (np.concatenate(marker_keys), np.concatenate(marker_stream)) \
+        , total, stream[starts]
+
+def count_symbols(units: np.ndarray, vectors: np.ndarray) -> np.ndarray:
+    'Symbol frequencies per table slot, shape (4, 256)'
+    (keys, _, _, _), (marker_keys, _), _, _ = huffman_symbols(units, vectors)
+    return (np.bincount(keys, minlength=4 * 256) + np.bincount(marker_keys, minlength=4 * 256)).reshape(4, 256)
+
+def huffman_events(units: np.ndarray, vectors: np.ndarray, dc_tables: list, ac_tables: list):
+    '''Zig-zag units with DC differences -> (value, length) of every code + extra bits in stream order,
+    stream index of every unit's first code'''
+    # 编码最长16位 + 附加位最多11位，int32 足够
+    codes = np.zeros((4, 256), np.int32)
+    lengths = np.zeros((4, 256), np.int32)
+    for slot, table in [*enumerate(dc_tables), *enumerate(ac_tables, 2)]:
+        codes[slot], lengths[slot] = table
+    codes = codes.reshape(-1)
+    lengths = lengths.reshape(-1)
+    (keys, extras, sizes, stream), (marker_keys, marker_stream), total, firsts = huffman_symbols(units, vectors)
+    values = np.empty(total, np.int32)
+    bits = np.empty(total, np.int32)
+    values[stream] = (codes[keys] << sizes) | extras
+    bits[stream] = lengths[keys] + sizes
+    values[marker_stream] = codes[marker_keys]
+    bits[marker_stream] = lengths[marker_keys]
+    return values, bits, firsts
+
+def pack_intervals(values: np.ndarray, lengths: np.ndarray, starts) -> list:
+    '''Concatenate codes MSB first into segments split before the codes at starts, pad each segment to a byte
+    boundary with 1 bits, then stuff 0x00 after every 0xFF -> bytes of every segment'''
+    bounds = np.concatenate([[0], starts, [len(values)]]).astype(np.int64)
+    offsets = np.empty(len(values) + 1, np.int64)
+    offsets[0] = 0
+    np.cumsum(lengths, out=offsets[1:])
+    segment_bits = np.diff(offsets[bounds])
+    padding = -segment_bits % 8
+    # 每段从字节边界开始：编码的位置加上前面各段补齐的位数
+    ends = np.cumsum(segment_bits + padding)
+    offsets = offsets[:-1]
+    if len(starts):
+        offsets += np.repeat(exclusive_cumsum(padding), np.diff(bounds))
+    # 每个编码最多27位，放进从所在32位字开始的64位窗口（左移溢出符号位不影响按位的结果）
+    shift = offsets & 31
+    shift += lengths
+    np.subtract(64, shift, out=shift)
+    window = values.astype(np.int64)
+    window <<= shift
+    window = window.view(np.uint64)
+    # 按所在32位字分组按位或；各组的高32位是本字，低32位并入下一个字
+    # 段尾补齐可能让某个字里没有编码开始，所以按字号而不是组号写回
+    word = offsets >> 5
+    groups = np.flatnonzero(np.concatenate([[True], word[1:] != word[:-1]]))
+    grouped = np.bitwise_or.reduceat(window, groups)
+    word = word[groups]
+    words = np.zeros(-(-int(ends[-1]) // 32) + 1, np.uint64)
+    words[word] = grouped >> np.uint64(32)
+    words[word + 1] |= grouped & np.uint64(0xFFFFFFFF)
+    data = words.astype('>u4').view(np.uint8)
+    # 每段最后一个字节的剩余位补1
+    ends //= 8
+    data[ends - 1] |= ((1 << padding) - 1).astype(np.uint8)
+    data = data.tobytes()
+    begins = np.concatenate([[0], ends[:-1]]).tolist()
+    return [data[begin: end].replace(b'\xff', b'\xff\x00') for begin, end in zip(begins, ends.tolist())]
+
+def pack_bits(values: np.ndarray, lengths: np.ndarray) -> bytes:
+    'Concatenate codes MSB first, pad the last byte with 1 bits, then stuff 0x00 after every 0xFF'
+    return pack_intervals(values, lengths, [])[0]
+
+def dc_differences(units: np.ndarray, vectors: np.ndarray, interval_units=0) -> np.ndarray:
+    'Replace DC with its difference to the previous unit of the same component, prediction resets every interval'
+    units = units.copy()
+    for index in np.unique(vectors):
+        position = np.nonzero(vectors == index)[0]
+        dc = units[position, 0]
+        difference = np.diff(dc, prepend=0)
+        if interval_units:
+            # 每个RST分段的第一个数据单元从0开始预测
+            interval = position // interval_units
+            first = np.ones(len(position), bool)
+            first[1:] = interval[1:] != interval[:-1]
+            difference[first] = dc[first]
+        units[position, 0] = difference
+    return units
+
+def encode_units(units: np.ndarray, vectors: np.ndarray, dc_tables: list, ac_tables: list) -> bytes:
+    'Entropy-code quantized zig-zag units given in scan order, DC prediction starts from 0'
+    return pack_bits(*huffman_events(dc_differences(units, vectors), vectors, dc_tables, ac_tables)[:2])
+
+def encode_intervals(units: np.ndarray, vectors: np.ndarray, dc_tables: list, ac_tables: list, interval_units):
+    'Entropy-code consecutive restart intervals of DC-differenced units, each padded to a byte boundary'
+    # 整体编码一次，再在每段第一个数据单元的编码之前切开
+    values, bits, firsts = huffman_events(units, vectors, dc_tables, ac_tables)
+    return pack_intervals(values, bits, firsts[interval_units::interval_units])
+
+def split_intervals(units: np.ndarray, vectors: np.ndarray, interval_units, parts):
+    'Split units into at most parts chunks on restart interval boundaries'
+    intervals = -(-len(units) // interval_units)
+    step = -(-intervals // parts) * interval_units
+    return [units[start: start + step] for start in range(0, len(units), step)] \
+        , [vectors[start: start + step] for start in range(0, len(units), step)]
+
+def write_data(f: BufferedWriter, units, vectors, dc_tables=None, ac_tables=None, interval_units=0, workers=1
+               , executor='process'):
+    # units 为已做DC差分的数据单元；interval_units > 0 时每段之后插入 RST0 ~ RST7
+    tables = np.minimum(vectors, 1)
+    dc_tables = [huffman_code_table(table) for table in dc_tables or [STD_DC_LUMINANCE, STD_DC_CHROMINANCE]]
+    ac_tables = [huffman_code_table(table) for table in ac_tables or [STD_AC_LUMINANCE, STD_AC_CHROMINANCE]]
+    if not interval_units:
+        f.write(pack_bits(*huffman_events(units, tables, dc_tables, ac_tables)[:2]))
+        return
+    if workers > 1:
+        # 各RST分段互相独立，可以并行编码后按顺序拼接
+        unit_parts, table_parts = split_intervals(units, tables, interval_units, workers * 4)
+        pool_type = ProcessPoolExecutor if executor == 'process' else ThreadPoolExecutor
+        with pool_type(max_workers=workers) as pool:
+            segments = [segment for part in pool.map(encode_intervals, unit_parts, table_parts, repeat(dc_tables)
+                                                     , repeat(ac_tables), repeat(interval_units))
+                        for segment in part]
+    else:
+        segments = encode_intervals(units, tables, dc_tables, ac_tables, interval_units)
+    for index, segment in enumerate(segments):
+        if index:
+            f.write(pack(">H", 0xffd0 + (index - 1) % 8))
+        f.write(segment)
+
+def optimize_tables(units, vectors, workers=1, executor='process'):
+    'First pass: gather symbol statistics of DC-differenced units -> optimal ([DC tables], [AC tables])'
+    tables = np.minimum(vectors, 1)
+    if workers > 1:
+        unit_parts, table_parts = split_intervals(units, tables, 1, workers)
+        pool_type = ProcessPoolExecutor if executor == 'process' else ThreadPoolExecutor
+        with pool_type(max_workers=workers) as pool:
+            frequencies = sum(pool.map(count_symbols, unit_parts, table_parts))
+    else:
+        frequencies = count_symbols(units, tables)
+    count = 2 if tables.max() > 0 else 1
+    return [optimal_huffman_table(frequencies[slot]) for slot in range(count)] \
+        , [optimal_huffman_table(frequencies[slot + 2]) for slot in range(count)]
+
+def write_file(path: str, pixels: np.ndarray, quality=75, subsampling='4:2:0', optimize=False, restart_interval=0
+               , workers=1, executor='process'):
+    # pixels: H x W x 3 的RGB或者 H x W 的灰度 uint8 数组（或Raster）
+    # optimize: 先统计符号频率生成本图最优哈夫曼表（两遍编码）
+    # restart_interval: 每段MCU数，> 0 时写入DRI；workers > 1 时各段并行编码，executor为'process'或'thread'
+    if subsampling not in SUBSAMPLING:
+        raise ValueError(f'Subsampling Error, Expect one of {list(SUBSAMPLING)}, Read({subsampling})')
+    pixels = np.asarray(pixels)
+    if not 0 <= restart_interval <= 0xFFFF:
+        raise ValueError(f'Restart Interval Error, Expect 0 ~ 65535, Read({restart_interval})')
+    height, width = pixels.shape[:2]
+    quantization_tables = [quality_table(STD_LUMINANCE_QUANTIZATION, quality)
+                           , quality_table(STD_CHROMINANCE_QUANTIZATION, quality)]
+    observer = get_observer()
+    with observer.span('prepare_units', subsampling=subsampling):
+        units, vectors, factors, mcu_count = prepare_units(pixels, quantization_tables, subsampling)
+    observer.count('blocks_encoded', len(units))
+    interval_units = restart_interval * (len(units) // mcu_count)
+    units = dc_differences(units, vectors, interval_units)
+    dc_tables, ac_tables = None, None
+    if optimize:
+        with observer.span('optimize_tables'):
+            dc_tables, ac_tables = optimize_tables(units, vectors, workers, executor)
+    with observer.span('entropy_code', workers=workers), open(path, 'wb') as f:
+        write_header(f, width, height, quantization_tables, factors, dc_tables, ac_tables, restart_interval)
+        write_data(f, units, vectors, dc_tables, ac_tables, interval_units, workers, executor)
+        write_eoi(f)
 
 if __name__ == '__main__':
-    # write_file(r'./test.jpeg')
-    pass
\ No newline at end of file
+    from bmp import read_file
+    pixels, _, _ = read_file(r'./img/suey.bmp')
+    write_file(r'./test.jpeg', pixels)
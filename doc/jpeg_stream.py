@@ -0,0 +1,252 @@
+import asyncio
+from struct import unpack_from
+
+from instrument import get_observer
+from jpeg_decoder import BitReader, Frame, Jpeg, decode_mcus
+
+def find_marker(data: bytearray, pos: int):
+    '''First marker at or after pos inside entropy-coded data -> (offset of its 0xFF, marker byte)
+    (offset, None) when there is none yet, data before offset is complete and can be consumed'''
+    while True:
+        pos = data.find(b'\xff', pos)
+        if pos == -1:
+            return len(data), None
+        if pos + 1 >= len(data):
+            return pos, None
+        marker = data[pos + 1]
+        if marker == 0x00:
+            pos += 2
+        elif marker == 0xFF:
+            pos += 1
+        else:
+            return pos, marker
+
+def entropy_end(data: bytearray, start: int, end: int) -> int:
+    # marker前的0xFF都是填充字节；数据末尾的0xFF可能是下一个标记或0xFF00的前半部分，留到下次
+    while end > start and data[end - 1] == 0xFF:
+        end -= 1
+    return end
+
+class JpegParser(Jpeg):
+    'Push parser: feed() bytes as they arrive, headers and baseline MCUs are decoded as soon as they are complete'
+    # buffer        尚未解析的原始字节
+    # pending       基线：当前RST分段中已反填充、尚未解码成完整MCU的数据，bit_offset为其中已消耗的位数
+    #               渐进式：当前扫描已收到的各RST分段（反填充后），整个扫描收齐后一次解码
+    # min_decode    pending 至少新增这么多字节才尝试解码分段中间的MCU，避免小块数据反复试解码
+    # preview       渐进式每次扫描后的回调 preview(pixels, scan_index, bytes_received)
+    def __init__(self, scale: float = 1, upsampling: str = 'fancy', preview=None, min_decode: int = 4096) -> None:
+        if scale not in (1, 1 / 2, 1 / 4, 1 / 8):
+            raise ValueError(f'Scale Error, Expect 1, 1/2, 1/4 or 1/8, Read({scale})')
+        self.scale = scale
+        self.upsampling = upsampling
+        self.preview = preview
+        self.min_decode = min_decode
+        self.frame = Frame()
+        self._start_segments()
+        self.buffer = bytearray()
+        self.pending = bytearray()
+        self.chunks = []
+        self.bit_offset = 0
+        self.checked = 0
+        # 'soi' -> 'marker' <-> 'scan' -> 'end'
+        self.state = 'soi'
+        self.received = 0
+        self.scan_count = 0
+        self.pixels = None
+
+    def feed(self, data: bytes):
+        'Parse and decode as far as the bytes received so far allow'
+        if self.pixels is not None:
+            raise ValueError('Feed Error, Parser Already Closed')
+        self.received += len(data)
+        if self.state == 'end':
+            return
+        self.buffer += data
+        pos = 0
+        while self.state != 'end':
+            step = self.parse_marker(pos) if self.state != 'scan' else self.parse_scan(pos)
+            if step is None:
+                break
+            pos = step
+        # 只保留未解析的字节
+        del self.buffer[:pos]
+
+    def close(self):
+        'Decode whatever is left (a truncated tail keeps the MCUs decoded so far) -> pixels'
+        if self.pixels is not None:
+            return self.pixels
+        if self.state == 'scan':
+            self.append_entropy(0, len(self.buffer))
+            self.end_interval()
+            self.end_scan()
+        if not hasattr(self, 'sos'):
+            raise ValueError('Stream Error, No Scan Data Received')
+        self.buffer = bytearray()
+        with get_observer().span('reconstruct'):
+            self.pixels = self.reconstruct()
+        return self.pixels
+
+    def mcus_decoded(self) -> int:
+        'Complete MCUs entropy-decoded so far, baseline only'
+        if not self.frame.unit_count:
+            return 0
+        return sum(self.frame.unit_count) // len(self.vector_order)
+
+    def parse_marker(self, pos: int):
+        buffer = self.buffer
+        if len(buffer) - pos < 2:
+            return None
+        if buffer[pos] != 0xFF:
+            offset = self.received - len(buffer) + pos
+            raise ValueError(f'Marker Error, Expect 0xFF, Read({hex(buffer[pos])}) at {offset}')
+        marker = buffer[pos + 1]
+        if marker == 0xFF:
+            # 填充字节
+            return pos + 1
+        if self.state == 'soi':
+            if marker != 0xD8:
+                raise ValueError(f'SOI Error, Expect(0xd8), Read({hex(marker)})')
+            self.state = 'marker'
+            return pos + 2
+        if marker == 0xD9:
+            self.state = 'end'
+            return pos + 2
+        if 0xD0 <= marker <= 0xD7:
+            return pos + 2
+        if len(buffer) - pos < 4:
+            return None
+        length = unpack_from('>H', buffer, pos + 2)[0]
+        if len(buffer) - pos < 2 + length:
+            return None
+        self._parse_segment(memoryview(bytes(buffer[pos + 1: pos + 2 + length])))
+        if marker == 0xDA:
+            self.start_scan()
+        return pos + 2 + length
+
+    def start_scan(self):
+        if self.scan_count == 0:
+            self._build_frame()
+            frame = self.frame
+            mcu_cols, mcu_rows, _, _ = frame.get_mcu_layout()
+            self.mcu_count = mcu_cols * mcu_rows
+            frame.units = frame.allocate_units(self.mcu_count)
+            # 渐进式各扫描写入同一个缓冲区，基线按已解码的数据单元数推进
+            frame.unit_count = [len(units) for units in frame.units] if self.progressive else [0] * len(frame.factor)
+            self.vector_order = frame.get_mcu_order()
+            if not self.progressive:
+                self.dc_tables, self.ac_tables = frame.get_huffman_tables()
+        self.scan_tables = dict(self.huffman_tables)
+        self.scan_interval = self.restart_interval
+        self.chunks = []
+        self.start_interval()
+        self.state = 'scan'
+
+    def start_interval(self):
+        self.pending = bytearray()
+        self.bit_offset = 0
+        self.checked = 0
+        self.interval_mcus = 0
+        self.dc_base = [0] * len(self.frame.factor)
+
+    def parse_scan(self, pos: int):
+        end, marker = find_marker(self.buffer, pos)
+        if marker is None:
+            end = entropy_end(self.buffer, pos, end)
+            if end == pos:
+                return None
+            self.append_entropy(pos, end)
+            if not self.progressive and len(self.pending) - self.checked >= self.min_decode:
+                self.decode_pending(final=False)
+            return end
+        self.append_entropy(pos, end)
+        self.end_interval()
+        if 0xD0 <= marker <= 0xD7:
+            self.start_interval()
+            return end + 2
+        # 其他标记结束本次扫描，交给parse_marker
+        self.end_scan()
+        return end
+
+    def append_entropy(self, start: int, end: int):
+        end = entropy_end(self.buffer, start, end)
+        self.pending += bytes(self.buffer[start: end]).replace(b'\xff\x00', b'\xff')
+
+    def end_interval(self):
+        if self.progressive:
+            self.chunks.append(bytes(self.pending))
+        else:
+            self.decode_pending(final=True)
+
+    def end_scan(self):
+        self.state = 'marker'
+        if self.progressive and self.chunks:
+            with get_observer().span('decode_scan', scan=self.scan_count):
+                self.decode_scan(self.sos, self.scan_tables, self.scan_interval, self.chunks)
+            self.chunks = []
+            if self.preview is not None:
+                self.preview(self.reconstruct(), self.scan_count, self.received)
+        self.scan_count += 1
+
+    def decode_pending(self, final: bool):
+        'Baseline: decode the complete MCUs in pending and drop their bytes'
+        frame = self.frame
+        interval = self.scan_interval or self.mcu_count
+        limit = min(interval - self.interval_mcus, self.mcu_count - self.mcus_decoded())
+        reader = BitReader(self.pending)
+        if self.bit_offset:
+            reader.bits(self.bit_offset)
+        consumed = self.bit_offset
+        count = 0
+        while count < limit:
+            # 数据不足时decode_mcus会丢弃不完整的MCU，DC预测也要恢复到该MCU之前
+            dc_base = list(self.dc_base)
+            cursors = list(frame.unit_count)
+            try:
+                decoded = decode_mcus(reader, self.dc_base, self.vector_order, self.dc_tables, self.ac_tables
+                                      , frame.units, frame.unit_count, 1)
+            except ValueError:
+                # 读到pending末尾补的0时可能先报码字错误（码字最长16位），这时同样是数据不足，等待后续数据（或截断于此）
+                if reader.remaining() >= 16:
+                    raise
+                for index, unit in enumerate(frame.units):
+                    unit[cursors[index]: cursors[index] + self.vector_order.count(index)] = 0
+                frame.unit_count[:] = cursors
+                decoded = 0
+            if not decoded:
+                self.dc_base = dc_base
+                break
+            consumed = reader.consumed()
+            count += 1
+        self.interval_mcus += count
+        get_observer().count('blocks_decoded', count * len(self.vector_order))
+        if final:
+            return
+        del self.pending[: consumed // 8]
+        self.bit_offset = consumed % 8
+        self.checked = len(self.pending)
+
+async def decode_async(source, scale: float = 1, upsampling: str = 'fancy', preview=None, chunk_size: int = 1 << 16
+                       , offload: bool = True):
+    '''Decode a JPEG from an asyncio.StreamReader (anything with async read(n)) or an async iterator of bytes
+    offload runs each feed() in the default executor so the event loop keeps receiving while MCUs are decoded'''
+    parser = JpegParser(scale, upsampling, preview)
+    loop = asyncio.get_running_loop()
+
+    async def feed(data):
+        if offload:
+            await loop.run_in_executor(None, parser.feed, data)
+        else:
+            parser.feed(data)
+
+    if hasattr(source, 'read'):
+        while True:
+            data = await source.read(chunk_size)
+            if not data:
+                break
+            await feed(data)
+    else:
+        async for data in source:
+            await feed(data)
+    if offload:
+        return await loop.run_in_executor(None, parser.close)
+    return parser.close()
@@ -0,0 +1,209 @@
+from argparse import ArgumentParser
+from math import ceil
+import sys
+
+import numpy as np
+
+import jpeg_encoder
+from instrument import get_observer
+from jpeg_decoder import ZIGZAG, Jpeg
+
+# 自然顺序的 8x8 系数，下标 = 8 * 垂直频率 + 水平频率
+# 水平翻转时奇数水平频率取反，垂直翻转时奇数垂直频率取反
+FLIP_HORIZONTAL = np.where(np.arange(64) % 2, -1, 1).astype(np.int16)
+FLIP_VERTICAL = np.where(np.arange(64) // 8 % 2, -1, 1).astype(np.int16)
+TRANSPOSE = np.arange(64).reshape(8, 8).T.ravel()
+ROTATIONS = (0, 90, 180, 270)
+FLIPS = (None, 'horizontal', 'vertical')
+
+class Coefficients:
+    'Quantized DCT blocks of a JPEG on their block grids, transformed losslessly without IDCT or requantization'
+    # width / height    像素尺寸
+    # factors           每个分量的 (水平采样, 垂直采样)
+    # planes            每个分量 (块行, 块列, 64)，自然顺序的量化系数，始终是整数个MCU
+    # tables            每个分量的量化表，自然顺序
+    # restart_interval  原图的RST间隔（MCU数），写出时默认沿用
+    def __init__(self, width: int, height: int, factors: list, planes: list, tables: list
+                 , restart_interval: int = 0) -> None:
+        self.width = width
+        self.height = height
+        self.factors = factors
+        self.planes = planes
+        self.tables = tables
+        self.restart_interval = restart_interval
+
+    def read(path: str, workers: int = 1):
+        'Entropy-decode a baseline or progressive JPEG into coefficient blocks, workers as in Frame.decode_huffman'
+        jpeg = Jpeg(path, stream=True)
+        frame = jpeg.frame
+        if jpeg.progressive:
+            for _ in jpeg.decode_scans():
+                pass
+        else:
+            frame.decode_huffman(workers)
+        mcu_cols, mcu_rows, _, _ = frame.get_mcu_layout()
+        dqt_values = {dqt.id: dqt.values for dqt in jpeg.dqt_list}
+        factors, planes, tables = [], [], []
+        for index, units in enumerate(frame.units):
+            horizontal, vertical = frame.get_vector_factor(index)
+            # MCU顺序 -> 块网格，zig-zag -> 自然顺序
+            grid = units.reshape(mcu_rows, mcu_cols, vertical, horizontal, 64).transpose(0, 2, 1, 3, 4) \
+                .reshape(mcu_rows * vertical, mcu_cols * horizontal, 64)[..., ZIGZAG]
+            factors.append((horizontal, vertical))
+            planes.append(grid)
+            tables.append(dqt_values[frame.dqt_map[index][1]][ZIGZAG])
+        return Coefficients(frame.width, frame.height, factors, planes, tables, frame.restart_interval)
+
+    def get_mcu_size(self):
+        'MCU width and height in pixels'
+        return 8 * max(horizontal for horizontal, _ in self.factors), 8 * max(vertical for _, vertical in self.factors)
+
+    def crop(self, x: int, y: int, w: int, h: int):
+        # 左上角向下对齐到MCU边界（与jpegtran相同），宽高相应扩大
+        mcu_width, mcu_height = self.get_mcu_size()
+        if x < 0 or y < 0 or w <= 0 or h <= 0 or x + w > self.width or y + h > self.height:
+            raise ValueError(f'Crop Error, ({x}, {y}, {w}, {h}) out of {self.width} x {self.height}')
+        col = x // mcu_width
+        row = y // mcu_height
+        self.width = w + x - col * mcu_width
+        self.height = h + y - row * mcu_height
+        mcu_cols = ceil(self.width / mcu_width)
+        mcu_rows = ceil(self.height / mcu_height)
+        self.planes = [plane[row * vertical: (row + mcu_rows) * vertical, col * horizontal: (col + mcu_cols) * horizontal]
+                       for plane, (horizontal, vertical) in zip(self.planes, self.factors)]
+        return self
+
+    def flip_horizontal(self):
+        # 右边不足一个MCU的部分无法镜像到左边，直接裁掉（与jpegtran -trim相同）
+        mcu_width, _ = self.get_mcu_size()
+        mcu_cols = self.width // mcu_width
+        if not mcu_cols:
+            raise ValueError(f'Flip Error, Width({self.width}) less than one MCU({mcu_width})')
+        self.width = mcu_cols * mcu_width
+        self.planes = [plane[:, mcu_cols * horizontal - 1:: -1] * FLIP_HORIZONTAL
+                       for plane, (horizontal, _) in zip(self.planes, self.factors)]
+        return self
+
+    def flip_vertical(self):
+        _, mcu_height = self.get_mcu_size()
+        mcu_rows = self.height // mcu_height
+        if not mcu_rows:
+            raise ValueError(f'Flip Error, Height({self.height}) less than one MCU({mcu_height})')
+        self.height = mcu_rows * mcu_height
+        self.planes = [plane[mcu_rows * vertical - 1:: -1] * FLIP_VERTICAL
+                       for plane, (_, vertical) in zip(self.planes, self.factors)]
+        return self
+
+    def transpose(self):
+        # 块网格和块内系数同时转置，采样因子和量化表也要转置
+        self.width, self.height = self.height, self.width
+        self.factors = [(vertical, horizontal) for horizontal, vertical in self.factors]
+        self.planes = [plane.transpose(1, 0, 2)[..., TRANSPOSE] for plane in self.planes]
+        self.tables = [table[TRANSPOSE] for table in self.tables]
+        return self
+
+    def rotate(self, degrees: int):
+        'Clockwise rotation by 90, 180 or 270 degrees'
+        if degrees not in ROTATIONS:
+            raise ValueError(f'Rotate Error, Expect one of {ROTATIONS}, Read({degrees})')
+        if degrees == 90:
+            return self.transpose().flip_horizontal()
+        if degrees == 180:
+            return self.flip_horizontal().flip_vertical()
+        if degrees == 270:
+            return self.transpose().flip_vertical()
+        return self
+
+    def units(self):
+        'Zig-zag units in scan order, component index of each unit and MCU count, as from prepare_units'
+        mcu_width, mcu_height = self.get_mcu_size()
+        mcu_cols = ceil(self.width / mcu_width)
+        mcu_rows = ceil(self.height / mcu_height)
+        units = []
+        for plane, (horizontal, vertical) in zip(self.planes, self.factors):
+            units.append(plane[..., jpeg_encoder.UNZIGZAG]
+                         .reshape(mcu_rows, vertical, mcu_cols, horizontal, 64).transpose(0, 2, 1, 3, 4)
+                         .reshape(mcu_rows * mcu_cols, vertical * horizontal, 64))
+        vectors = np.concatenate([np.full(unit.shape[1], index) for index, unit in enumerate(units)])
+        units = np.concatenate(units, axis=1).reshape(-1, 64)
+        return units, np.tile(vectors, mcu_rows * mcu_cols), mcu_rows * mcu_cols
+
+    def write(self, path: str, optimize: bool = True, restart_interval: int = None, workers: int = 1):
+        'Re-entropy-code the blocks with the encoder writers, quantization tables are kept'
+        if restart_interval is None:
+            restart_interval = self.restart_interval
+        if not 0 <= restart_interval <= 0xFFFF:
+            raise ValueError(f'Restart Interval Error, Expect 0 ~ 65535, Read({restart_interval})')
+        # 量化表按出现顺序重新编号，SOS中亮度用0号哈夫曼表，其余分量用1号
+        tables = []
+        factors = []
+        for index, (table, (horizontal, vertical)) in enumerate(zip(self.tables, self.factors)):
+            if table.max() > 255:
+                raise ValueError('Write Error, 16-bit quantization tables are not supported by the encoder')
+            table_id = next((table_id for table_id, known in enumerate(tables) if np.array_equal(known, table))
+                            , len(tables))
+            if table_id == len(tables):
+                tables.append(table)
+            factors.append((index + 1, horizontal, vertical, table_id))
+        units, vectors, mcu_count = self.units()
+        interval_units = restart_interval * (len(units) // mcu_count)
+        units = jpeg_encoder.dc_differences(units, vectors, interval_units)
+        dc_tables, ac_tables = None, None
+        if optimize:
+            dc_tables, ac_tables = jpeg_encoder.optimize_tables(units, vectors, workers)
+        dc_tables = dc_tables or [jpeg_encoder.STD_DC_LUMINANCE, jpeg_encoder.STD_DC_CHROMINANCE]
+        ac_tables = ac_tables or [jpeg_encoder.STD_AC_LUMINANCE, jpeg_encoder.STD_AC_CHROMINANCE]
+        with open(path, 'wb') as f:
+            jpeg_encoder.write_soi(f)
+            jpeg_encoder.write_app0(f)
+            for table_id, table in enumerate(tables):
+                jpeg_encoder.write_dqt(f, table_id, table)
+            jpeg_encoder.write_sof0(f, self.width, self.height, factors)
+            for table_id in range(min(len(factors), 2)):
+                jpeg_encoder.write_dht(f, 0, table_id, dc_tables[table_id])
+                jpeg_encoder.write_dht(f, 1, table_id, ac_tables[table_id])
+            if restart_interval:
+                jpeg_encoder.write_dri(f, restart_interval)
+            jpeg_encoder.write_sos(f, len(factors))
+            jpeg_encoder.write_data(f, units, vectors, dc_tables, ac_tables, interval_units, workers)
+            jpeg_encoder.write_eoi(f)
+
+def transform_file(source: str, target: str, crop: tuple = None, rotate: int = 0, flip: str = None
+                   , optimize: bool = True, restart_interval: int = None, workers: int = 1):
+    '''Lossless crop (x, y, w, h in source pixels), then flip ('horizontal' / 'vertical'), then clockwise rotation
+    Edges that are not whole MCUs are trimmed when they would be mirrored, restart_interval None keeps the source's'''
+    if flip not in FLIPS:
+        raise ValueError(f'Flip Error, Expect one of {FLIPS}, Read({flip})')
+    observer = get_observer()
+    with observer.span('read_coefficients', path=source):
+        coefficients = Coefficients.read(source, workers)
+    with observer.span('transform'):
+        if crop:
+            coefficients.crop(*crop)
+        if flip == 'horizontal':
+            coefficients.flip_horizontal()
+        elif flip == 'vertical':
+            coefficients.flip_vertical()
+        coefficients.rotate(rotate)
+    with observer.span('entropy_code'):
+        coefficients.write(target, optimize, restart_interval, workers)
+    return coefficients
+
+def main(argv=None):
+    parser = ArgumentParser(description='Crop, rotate or flip a JPEG losslessly in the DCT domain')
+    parser.add_argument('source')
+    parser.add_argument('target')
+    parser.add_argument('--crop', nargs=4, type=int, metavar=('X', 'Y', 'W', 'H'))
+    parser.add_argument('--rotate', type=int, default=0, choices=ROTATIONS, help='clockwise degrees')
+    parser.add_argument('--flip', choices=FLIPS[1:])
+    parser.add_argument('--standard-tables', action='store_true', help='Annex K Huffman tables instead of optimal')
+    parser.add_argument('--restart', type=int, default=None, help='restart interval in MCUs, default as source')
+    parser.add_argument('-j', '--workers', type=int, default=1, help='processes for restart intervals')
+    args = parser.parse_args(argv)
+    coefficients = transform_file(args.source, args.target, args.crop, args.rotate, args.flip
+                                  , not args.standard_tables, args.restart, args.workers)
+    print(f'{args.target}: {coefficients.width} x {coefficients.height}')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,115 @@
+import numpy as np
+
+# 通道排列 -> 每像素字节数
+LAYOUTS = {
+    'L': 1,
+    'RGB': 3,
+    'BGR': 3,
+    'RGBA': 4,
+}
+
+class Raster:
+    '''Decoded 8-bit pixels in one contiguous byte buffer, shared zero-copy with NumPy / PIL
+    memoryview(raster) / bytes(raster) need Python 3.12+ (PEP 688); np.asarray(raster) and raster.memoryview()
+    share the buffer on any version'''
+    # buffer    一维字节memoryview（bytearray、array或numpy数组的内存），视图与原图共享同一块缓冲区
+    # offset    左上角像素在buffer中的字节偏移
+    # stride    相邻两行的字节跨度，裁剪视图沿用原图的跨度
+    def __init__(self, width: int, height: int, layout: str = 'RGB', buffer=None, stride: int = None
+                 , offset: int = 0) -> None:
+        if layout not in LAYOUTS:
+            raise ValueError(f'Layout Error, Expect one of {list(LAYOUTS)}, Read({layout})')
+        self.width = width
+        self.height = height
+        self.layout = layout
+        self.channels = LAYOUTS[layout]
+        self.stride = stride or width * self.channels
+        self.offset = offset
+        if buffer is None:
+            buffer = bytearray(offset + self.stride * height)
+        self.buffer = memoryview(buffer).cast('B')
+        end = offset + self.stride * (height - 1) + width * self.channels if height else offset
+        if width < 0 or height < 0 or self.stride < width * self.channels or end > len(self.buffer):
+            raise ValueError(f'Raster Error, {width} x {height} {layout} stride {self.stride} offset {offset}'
+                             f' out of {len(self.buffer)} bytes')
+
+    def from_array(array):
+        'Wrap a C-contiguous H x W (L) or H x W x 3 (RGB) / 4 (RGBA) uint8 array without copying'
+        if array.dtype != np.uint8 or not array.flags.c_contiguous:
+            raise ValueError(f'Raster Error, Expect a C-contiguous uint8 array, Read({array.dtype}, {array.strides})')
+        if array.ndim == 2:
+            layout = 'L'
+        elif array.ndim == 3 and array.shape[2] in (3, 4):
+            layout = 'RGB' if array.shape[2] == 3 else 'RGBA'
+        else:
+            raise ValueError(f'Raster Error, Unsupported Shape{array.shape}')
+        return Raster(array.shape[1], array.shape[0], layout, array.reshape(-1))
+
+    @property
+    def shape(self) -> tuple:
+        if self.channels == 1:
+            return self.height, self.width
+        return self.height, self.width, self.channels
+
+    @property
+    def nbytes(self) -> int:
+        return self.width * self.height * self.channels
+
+    def is_contiguous(self) -> bool:
+        return self.stride == self.width * self.channels or self.height <= 1
+
+    def row(self, y: int) -> memoryview:
+        'Bytes of row y as a view of the buffer'
+        if not 0 <= y < self.height:
+            raise IndexError(f'Row Error, {y} out of {self.height}')
+        start = self.offset + y * self.stride
+        return self.buffer[start: start + self.width * self.channels]
+
+    def rows(self):
+        for y in range(self.height):
+            yield self.row(y)
+
+    def crop(self, x: int, y: int, w: int, h: int):
+        'w x h window whose top-left pixel is (x, y), sharing this buffer'
+        if x < 0 or y < 0 or w <= 0 or h <= 0 or x + w > self.width or y + h > self.height:
+            raise ValueError(f'Region Error, ({x}, {y}, {w}, {h}) out of {self.width} x {self.height}')
+        return Raster(w, h, self.layout, self.buffer, self.stride
+                      , self.offset + y * self.stride + x * self.channels)
+
+    def memoryview(self) -> memoryview:
+        'Shaped (H, W[, C]) memoryview of a contiguous raster, no copy'
+        if not self.is_contiguous():
+            raise BufferError('Raster Error, Cropped view is not contiguous, use tobytes()')
+        return self.buffer[self.offset: self.offset + self.nbytes].cast('B', self.shape)
+
+    def __buffer__(self, flags: int) -> memoryview:
+        # Python 3.12+ 的缓冲区协议（PEP 688），memoryview(raster) / bytes(raster) 直接使用
+        return self.memoryview()
+
+    def tobytes(self) -> bytes:
+        if self.is_contiguous():
+            return self.buffer[self.offset: self.offset + self.nbytes].tobytes()
+        return b''.join(row.tobytes() for row in self.rows())
+
+    @property
+    def __array_interface__(self) -> dict:
+        # numpy.asarray 通过它直接引用buffer，裁剪视图通过strides和offset表达
+        # 总是给出strides：Python 3.12之前Raster本身没有缓冲区协议，PIL.Image.fromarray 会改用tobytes()
+        return {
+            'shape': self.shape,
+            'typestr': '|u1',
+            'strides': (self.stride, self.channels, 1)[:len(self.shape)],
+            'data': self.buffer,
+            'offset': self.offset,
+            'version': 3,
+        }
+
+    def to_image(self):
+        'PIL image (PIL is imported only here)'
+        from PIL import Image
+        data = self.buffer[self.offset: self.offset + self.nbytes] if self.is_contiguous() else self.tobytes()
+        mode = 'RGB' if self.layout == 'BGR' else self.layout
+        return Image.frombuffer(mode, (self.width, self.height), data, 'raw', self.layout, 0, 1)
+
+    def __repr__(self) -> str:
+        return f'Raster({self.width} x {self.height} {self.layout}, stride {self.stride})'
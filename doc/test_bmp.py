@@ -0,0 +1,36 @@
+from struct import pack
+
+import numpy as np
+import pytest
+
+import bmp
+
+def write_v5(path, rows: bytes, width, height, bit_count, compression, masks=(0, 0, 0, 0)):
+    # BITMAPV5HEADER（124字节），BI_RGB 时掩码字段为0
+    header = pack('<iiihhiiiiii', 124, width, height, 1, bit_count, compression, len(rows), 2835, 2835, 0, 0)
+    header += pack('<IIII', *masks) + b'\x00' * (124 - 40 - 16)
+    offset = 14 + len(header)
+    with open(path, 'wb') as f:
+        f.write(b'BM' + pack('<iHHi', offset + len(rows), 0, 0, offset) + header + rows)
+
+@pytest.mark.parametrize('compression, masks', [
+    (bmp.BiCompression.BI_RGB, (0, 0, 0, 0)),
+    (bmp.BiCompression.BI_BITFIELDS, (0xFF0000, 0xFF00, 0xFF, 0xFF000000)),
+])
+def test_v5_32bit(tmp_path, compression, masks):
+    rng = np.random.default_rng(0)
+    width, height = 7, 5
+    pixels = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+    bgrx = np.concatenate([pixels[:, :, ::-1], np.full((height, width, 1), 255, np.uint8)], axis=2)
+    path = str(tmp_path / 'v5.bmp')
+    write_v5(path, bgrx[::-1].tobytes(), width, height, 32, compression.value, masks)
+    raster, _, _ = bmp.read_file(path)
+    assert np.array_equal(np.asarray(raster), pixels)
+
+def test_v5_16bit_rgb(tmp_path):
+    # BI_RGB 的16位为 X1R5G5B5
+    values = np.array([[0x7C00, 0x03E0, 0x001F, 0x7FFF]], np.uint16)
+    path = str(tmp_path / 'v5_16.bmp')
+    write_v5(path, values.astype('<u2').tobytes(), 4, 1, 16, bmp.BiCompression.BI_RGB.value)
+    raster, _, _ = bmp.read_file(path)
+    assert np.asarray(raster).tolist() == [[[255, 0, 0], [0, 255, 0], [0, 0, 255], [255, 255, 255]]]
@@ -0,0 +1,39 @@
+import os
+
+import numpy as np
+import pytest
+
+from cache import DecodeCache
+
+def raster(value, size=10):
+    return np.full((size, size, 3), value, np.uint8)
+
+def test_byte_bound_and_lru():
+    cache = DecodeCache(max_bytes=3 * 300)
+    for key in 'abc':
+        cache.put(key, raster(ord(key)))
+    # 访问a后b成为最久未用的条目
+    assert cache.get('a')[0, 0, 0] == ord('a')
+    cache.put('d', raster(ord('d')))
+    stats = cache.stats()
+    assert stats['bytes'] == 900 and stats['entries'] == 3 and stats['evictions'] == 1
+    assert cache.get('b') is None
+    assert all(cache.get(key) is not None for key in 'acd')
+    cache.put('e', raster(ord('e'), 20))
+    # 超过整个预算的条目不进内存，没有溢出目录时直接丢弃
+    assert cache.stats()['bytes'] == 900 and cache.get('e') is None
+
+@pytest.mark.parametrize('disk_format', ['npy', 'raw'])
+def test_spill_reload(tmp_path, disk_format):
+    cache = DecodeCache(max_bytes=300, directory=str(tmp_path), disk_format=disk_format)
+    first = np.arange(300, dtype=np.uint8).reshape(10, 10, 3)
+    cache.put('first', first)
+    cache.put('second', raster(2))
+    assert cache.stats()['spills'] == 1
+    assert sorted(os.listdir(tmp_path)) == (['first.npy'] if disk_format == 'npy' else ['first.raw', 'first.raw.json'])
+    # 新实例只从磁盘读回
+    reloaded = DecodeCache(max_bytes=300, directory=str(tmp_path), disk_format=disk_format).get('first')
+    assert isinstance(reloaded, np.memmap) and not reloaded.flags.writeable
+    assert np.array_equal(reloaded, first)
+    cache.clear()
+    assert np.array_equal(cache.get('first'), first) and cache.stats()['disk_hits'] == 1
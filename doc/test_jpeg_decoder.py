@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+from PIL import Image
+
+import jpeg_decoder
+import jpeg_encoder
+from jpeg_decoder import Jpeg
+
+def noisy_pixels(width, height, seed=0):
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width]
+    pixels = np.stack([x * 255 // width, 128 + 0 * x, y * 255 // height], axis=2) + rng.normal(0, 30, (height, width, 3))
+    return np.clip(pixels, 0, 255).astype(np.uint8)
+
+@pytest.mark.parametrize('subsampling', ['4:4:4', '4:2:0'])
+@pytest.mark.parametrize('restart_interval', [1, 3, 7])
+def test_rows_optimized_restart_intervals(tmp_path, subsampling, restart_interval):
+    # 最优哈夫曼表时RST前的填充位常常能解码出一个MCU，rows()必须在每段restart_interval个MCU处停下
+    path = str(tmp_path / 'dri.jpg')
+    jpeg_encoder.write_file(path, noisy_pixels(75, 41), 90, subsampling, optimize=True
+                            , restart_interval=restart_interval)
+    expected = np.asarray(Jpeg(path).pixels)
+    rows = np.concatenate([np.asarray(strip) for strip in Jpeg(path, stream=True).rows()])
+    assert np.array_equal(rows, expected)
+
+def test_index_read_only_directory(tmp_path, monkeypatch):
+    # 目录只读时不写sidecar，仍按完整扫描的结果解码
+    path = str(tmp_path / 'indexed.jpg')
+    jpeg_encoder.write_file(path, noisy_pixels(75, 41), 90, '4:2:0', restart_interval=2)
+
+    def save(self, sidecar):
+        raise PermissionError(13, 'Permission denied', sidecar)
+
+    monkeypatch.setattr(jpeg_decoder.RestartIndex, 'save', save)
+    jpeg = Jpeg(path, stream=True, index=True)
+    assert not (tmp_path / 'indexed.jpg.rstidx').exists()
+    expected = np.asarray(Jpeg(path).pixels)
+    assert np.array_equal(np.asarray(jpeg.decode_region(10, 5, 30, 20)), expected[5:25, 10:40])
+
+def test_index_corrupt_sidecar(tmp_path):
+    path = str(tmp_path / 'indexed.jpg')
+    jpeg_encoder.write_file(path, noisy_pixels(75, 41), 90, '4:2:0', restart_interval=2)
+    (tmp_path / 'indexed.jpg.rstidx').write_bytes(b'RSTX')
+    assert np.array_equal(np.asarray(Jpeg(path, index=True).pixels), np.asarray(Jpeg(path).pixels))
+
+@pytest.mark.parametrize('content', [b'', b'not a jpeg', b'\x00' * 64], ids=['empty', 'text', 'zeros'])
+def test_no_markers(tmp_path, content):
+    path = tmp_path / 'plain.bin'
+    path.write_bytes(content)
+    with pytest.raises(ValueError, match='SOI Read Error'):
+        Jpeg(str(path))
+
+@pytest.mark.parametrize('subsampling', ['4:4:4', '4:2:0'])
+@pytest.mark.parametrize('restart', [0, 3])
+def test_progressive_matches_baseline(tmp_path, subsampling, restart):
+    # 同一像素同一质量，libjpeg量化出的系数相同，渐进式（SOF2）只是换了扫描顺序
+    image = Image.fromarray(noisy_pixels(75, 41, 3))
+    baseline = str(tmp_path / 'baseline.jpg')
+    progressive = str(tmp_path / 'progressive.jpg')
+    image.save(baseline, quality=90, subsampling=subsampling)
+    options = {'restart_marker_blocks': restart} if restart else {}
+    image.save(progressive, quality=90, subsampling=subsampling, progressive=True, **options)
+    with open(progressive, 'rb') as f:
+        data = f.read()
+    assert b'\xff\xc2' in data and (b'\xff\xdd' in data) == bool(restart)
+    jpeg = Jpeg(progressive)
+    assert jpeg.progressive
+    assert np.array_equal(np.asarray(jpeg.pixels), np.asarray(Jpeg(baseline).pixels))
@@ -0,0 +1,61 @@
+import os
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import jpeg_encoder
+from jpeg_decoder import Jpeg
+
+def smooth_pixels(width, height):
+    y, x = np.mgrid[0:height, 0:width]
+    pixels = np.stack([x * 255 // width, 128 + 100 * np.sin(x / 7) * np.cos(y / 11), y * 255 // height], axis=2)
+    return np.clip(pixels, 0, 255).astype(np.uint8)
+
+def psnr(expected, actual):
+    return 10 * np.log10(255 ** 2 / np.mean((expected.astype(np.float64) - actual) ** 2))
+
+@pytest.mark.parametrize('subsampling', ['4:4:4', '4:2:2', '4:2:0', 'gray'])
+@pytest.mark.parametrize('quality', [25, 50, 75, 95])
+def test_round_trip(tmp_path, subsampling, quality):
+    # 宽高都不是MCU的整数倍，覆盖边缘补齐
+    path = str(tmp_path / 'encoded.jpg')
+    reference = str(tmp_path / 'reference.jpg')
+    pixels = smooth_pixels(101, 67)
+    if subsampling == 'gray':
+        pixels = pixels[:, :, 1]
+        jpeg_encoder.write_file(path, pixels, quality)
+        Image.fromarray(pixels).save(reference, quality=quality)
+    else:
+        jpeg_encoder.write_file(path, pixels, quality, subsampling)
+        Image.fromarray(pixels).save(reference, quality=quality, subsampling=subsampling)
+    decoded = np.asarray(Jpeg(path).pixels)
+    with Image.open(path) as image:
+        assert np.abs(np.asarray(image).astype(np.int16) - decoded).max() <= 4
+    # 与libjpeg在同样的质量和采样下编码的结果相当
+    with Image.open(reference) as image:
+        assert psnr(pixels, decoded) > psnr(pixels, np.asarray(image)) - 0.5
+
+@pytest.mark.parametrize('subsampling', ['4:4:4', '4:2:0'])
+@pytest.mark.parametrize('optimize, restart_interval, workers', [
+    (True, 0, 1), (False, 1, 1), (False, 5, 1), (True, 5, 1), (True, 3, 2),
+])
+def test_entropy_options(tmp_path, subsampling, optimize, restart_interval, workers):
+    # 最优哈夫曼表和RST分段只改变熵编码，解码结果必须与默认编码完全相同
+    plain = str(tmp_path / 'plain.jpg')
+    path = str(tmp_path / 'options.jpg')
+    pixels = smooth_pixels(101, 67)
+    jpeg_encoder.write_file(plain, pixels, 85, subsampling)
+    jpeg_encoder.write_file(path, pixels, 85, subsampling, optimize, restart_interval, workers, 'thread')
+    assert np.array_equal(np.asarray(Jpeg(path).pixels), np.asarray(Jpeg(plain).pixels))
+    with Image.open(path) as image, Image.open(plain) as expected:
+        assert np.array_equal(np.asarray(image), np.asarray(expected))
+    with open(path, 'rb') as f:
+        data = f.read()
+    mcu_size = 8 if subsampling == '4:4:4' else 16
+    mcu_count = -(-101 // mcu_size) * -(-67 // mcu_size)
+    restarts = sum(data.count(bytes([0xFF, 0xD0 + index])) for index in range(8))
+    assert restarts == (-(-mcu_count // restart_interval) - 1 if restart_interval else 0)
+    if optimize:
+        jpeg_encoder.write_file(plain, pixels, 85, subsampling, restart_interval=restart_interval)
+        assert os.path.getsize(path) < os.path.getsize(plain)
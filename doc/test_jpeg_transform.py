@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+
+import jpeg_encoder
+from jpeg_decoder import Jpeg
+from jpeg_transform import Coefficients
+from test_jpeg_decoder import noisy_pixels
+
+# 最近邻上采样时每个像素只取决于所在的块，DCT域变换后的解码结果与像素域变换逐像素相同
+MCU_SIZES = {'4:4:4': (8, 8), '4:2:2': (16, 8), '4:2:0': (16, 16), 'gray': (8, 8)}
+
+def expected_pixels(pixels, operation, mcu_width, mcu_height):
+    # 翻转/旋转时不足一个MCU的右边和下边被裁掉（jpegtran -trim）
+    height, width = pixels.shape[:2]
+    width -= width % mcu_width
+    height -= height % mcu_height
+    if operation == 'crop':
+        return pixels[mcu_height: mcu_height + 20, mcu_width: mcu_width + 30]
+    if operation == 'horizontal':
+        return pixels[:, :width][:, ::-1]
+    if operation == 'vertical':
+        return pixels[:height][::-1]
+    if operation == 90:
+        return np.rot90(pixels[:height], -1)
+    if operation == 180:
+        return pixels[:height, :width][::-1, ::-1]
+    return np.rot90(pixels[:, :width], 1)
+
+@pytest.mark.parametrize('subsampling', list(MCU_SIZES))
+@pytest.mark.parametrize('operation', ['crop', 'horizontal', 'vertical', 90, 180, 270])
+def test_transform_matches_pixels(tmp_path, subsampling, operation):
+    source = str(tmp_path / 'source.jpg')
+    target = str(tmp_path / 'target.jpg')
+    pixels = noisy_pixels(75, 41)
+    if subsampling == 'gray':
+        jpeg_encoder.write_file(source, pixels[:, :, 0], 90)
+    else:
+        jpeg_encoder.write_file(source, pixels, 90, subsampling)
+    mcu_width, mcu_height = MCU_SIZES[subsampling]
+    coefficients = Coefficients.read(source)
+    if operation == 'crop':
+        coefficients.crop(mcu_width, mcu_height, 30, 20)
+    elif operation in ('horizontal', 'vertical'):
+        getattr(coefficients, f'flip_{operation}')()
+    else:
+        coefficients.rotate(operation)
+    coefficients.write(target)
+    decoded = np.asarray(Jpeg(source, upsampling='nearest').pixels)
+    expected = expected_pixels(decoded, operation, mcu_width, mcu_height)
+    assert np.array_equal(np.asarray(Jpeg(target, upsampling='nearest').pixels), expected)
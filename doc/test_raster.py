@@ -0,0 +1,26 @@
+import numpy as np
+import pytest
+
+from raster import Raster
+
+def test_asarray_shares_memory():
+    pixels = np.arange(5 * 7 * 3, dtype=np.uint8).reshape(5, 7, 3)
+    raster = Raster.from_array(pixels)
+    array = np.asarray(raster)
+    assert np.shares_memory(array, pixels) and np.array_equal(array, pixels)
+    # 裁剪视图通过strides和offset引用同一块缓冲区
+    window = np.asarray(raster.crop(2, 1, 3, 2))
+    assert np.shares_memory(window, pixels) and np.array_equal(window, pixels[1:3, 2:5])
+    pixels[1, 2] = 0
+    assert not window[0, 0].any()
+
+def test_asarray_shares_bytearray():
+    buffer = bytearray(4 * 6)
+    array = np.asarray(Raster(6, 4, 'L', buffer))
+    array[3, 5] = 255
+    assert buffer[-1] == 255 and array.shape == (4, 6)
+
+@pytest.mark.skipif(not hasattr(memoryview, '__buffer__'), reason='PEP 688 needs Python 3.12+')
+def test_buffer_protocol():
+    pixels = np.arange(4 * 3, dtype=np.uint8).reshape(4, 3)
+    assert bytes(Raster.from_array(pixels)) == pixels.tobytes()